@@ -0,0 +1,486 @@
+#coding: utf-8
+'''
+Offline benchmark for the ZhstatHarvester pipeline
+
+Generates a synthetic metadata.xml catalogue, serves it from an in-process
+S3 stand-in and times gather_stage, _generate_metadata and import_stage
+against a stub CKAN action and model layer. Nothing is written to the
+database or sent to S3, but CKAN and ckanext-harvest need to be installed
+to import the harvester.
+
+Usage:
+
+    python benchmarks/bench_harvester.py --datasets 2000 --languages 4 \\
+        --resources 3 [--no-listing] [--repeat 3] \\
+        [--storage s3-concurrent] [--latency 0.05] [--bandwidth 10] \\
+        [--manifest] [--chunked]
+'''
+
+import gc
+import hashlib
+import optparse
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from uuid import uuid4
+
+from ckanext.zhstat.harvesters import zhstatharvester
+from ckanext.zhstat.harvesters.zhstatharvester import ZhstatHarvester
+from ckanext.zhstat.storage import get_storage
+
+LANGUAGES = ['de', 'fr', 'it', 'en']
+
+
+def generate_catalogue(datasets, languages, resources):
+    '''
+    Return the content of a metadata.xml with the given number of
+    datasets, languages per dataset and resources per language, and a
+    dict of the files referenced by the resources
+    '''
+    files = {}
+    lines = ['<?xml version="1.0" encoding="utf-8"?>', '<datasets>']
+    for i in range(datasets):
+        lines.append('<dataset id="dataset-%05d">' % i)
+        for lang in (LANGUAGES * languages)[:languages]:
+            lines.append('<data xml:lang="%s">' % lang)
+            lines.append('<title>Datensatz %s %d</title>' % (lang, i))
+            lines.append('<url>http://statistik.zh.ch/%d</url>' % i)
+            lines.append('<author>Statistisches Amt %s</author>' % lang)
+            lines.append('<author_email>datashop@statistik.zh.ch'
+                         '</author_email>')
+            lines.append('<maintainer>Statistisches Amt %s</maintainer>'
+                         % lang)
+            lines.append('<maintainer_email>datashop@statistik.zh.ch'
+                         '</maintainer_email>')
+            lines.append('<description>Beschreibung %s %d</description>'
+                         % (lang, i))
+            lines.append('<license url="http://opendata.admin.ch/">'
+                         'cc-zero</license>')
+            lines.append('<version>1.%d</version>' % (i % 10))
+            lines.append('<tags><tag>Tag %s %d</tag><tag>Zürich %s</tag>'
+                         '</tags>' % (lang, i % 50, lang))
+            lines.append('<groups><group>Gruppe %s %d</group></groups>'
+                         % (lang, i % 12))
+            lines.append('<resources>')
+            for j in range(resources):
+                name = 'dataset_%05d_%s_%d.csv' % (i, lang, j)
+                files[name] = 'x' * (1000 + j)
+                lines.append('<resource><name>%s</name><type>CSV</type>'
+                             '<description>Ressource %d</description>'
+                             '</resource>' % (name, j))
+            lines.append('</resources>')
+            lines.append('</data>')
+        lines.append('</dataset>')
+    lines.append('</datasets>')
+    return '\n'.join(lines), files
+
+
+class FakeS3(object):
+    '''
+    In-process stand-in for an S3 bucket that counts the requests made
+    '''
+
+    PAGE_SIZE = 1000
+
+    def __init__(self, name, files, latency=0.0, bandwidth=0.0):
+        self.name = name
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.etags = dict(
+            (key, hashlib.md5(content).hexdigest())
+            for key, content in files.items()
+        )
+        self.requests = {}
+        # The files are probed from a thread pool
+        self.requests_lock = threading.Lock()
+        self.connection = self
+
+    def count(self, request):
+        with self.requests_lock:
+            self.requests[request] = self.requests.get(request, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list(self, prefix=''):
+        names = sorted(k for k in self.files if k.startswith(prefix))
+        for offset in range(0, len(names), self.PAGE_SIZE):
+            self.count('LIST')
+            for name in names[offset:offset + self.PAGE_SIZE]:
+                yield self._key(name)
+
+    def new_key(self, name):
+        key = FakeKey(self)
+        key.key = name
+        return key
+
+    def get_key(self, name):
+        self.count('HEAD')
+        if name not in self.files:
+            return None
+        return self._key(name)
+
+    def generate_url(self, expires_in, method='GET', bucket='', key='',
+                     **kwargs):
+        return 'http://%s.s3.amazonaws.com/%s' % (bucket, key)
+
+    def _key(self, name):
+        key = FakeKey(self)
+        key.key = name
+        key.size = len(self.files[name])
+        key.etag = '"%s"' % self.etags[name]
+        key.last_modified = 'Mon, 01 Jul 2013 00:00:00 GMT'
+        key.content_type = 'text/csv'
+        return key
+
+
+class FakeKey(object):
+    '''
+    Stand-in for boto.s3.key.Key on a FakeS3 bucket
+    '''
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key = None
+        self.offset = 0
+
+    @property
+    def name(self):
+        return self.key
+
+    def open_read(self, headers=None):
+        self.bucket.count('GET')
+        self.etag = '"%s"' % self.bucket.etags[self.key]
+        self.last_modified = 'Mon, 01 Jul 2013 00:00:00 GMT'
+        self.offset = 0
+
+    def read(self, size=0):
+        content = self.bucket.files[self.key]
+        if size == 0:
+            size = len(content)
+        data = content[self.offset:self.offset + size]
+        self.offset += len(data)
+        if self.bucket.bandwidth:
+            time.sleep(len(data) / (self.bucket.bandwidth * 1024 * 1024))
+        return data
+
+    def close(self):
+        pass
+
+    def generate_url(self, expires_in, **kwargs):
+        return self.bucket.generate_url(
+            expires_in,
+            bucket=self.bucket.name,
+            key=self.key
+        )
+
+
+class FakeSession(object):
+    '''
+    Stand-in for the CKAN database session
+    '''
+
+    def __init__(self):
+        self.commits = 0
+        self.objects = []
+
+    def add_all(self, objects):
+        for obj in objects:
+            if obj.id is None:
+                obj.id = str(uuid4())
+        self.objects.extend(objects)
+
+    def flush(self):
+        pass
+
+    def commit(self):
+        self.commits += 1
+
+    def query(self, *args):
+        return FakeQuery()
+
+
+class FakeQuery(object):
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def all(self):
+        return []
+
+    def scalar(self):
+        return None
+
+
+class FakePublisher(object):
+    '''
+    Stand-in for the fetch queue publisher that records when the first
+    message was sent
+    '''
+
+    def __init__(self):
+        self.messages = []
+        self.first_sent = None
+
+    def send(self, body):
+        if self.first_sent is None:
+            self.first_sent = time.time()
+        self.messages.append(body)
+
+    def close(self):
+        pass
+
+
+class FakeHarvestObject(object):
+
+    def __init__(self, **kwargs):
+        self.id = None
+        self.harvest_job_id = 'benchmark-job'
+        self.state = None
+        self.__dict__.update(kwargs)
+
+
+class FakeModel(object):
+    '''
+    Stand-in for the parts of ckan.model that import_stage uses
+    '''
+
+    class User(object):
+        @staticmethod
+        def get(name):
+            return None
+
+    class Package(object):
+        name = 'name'
+        id = 'id'
+
+        @staticmethod
+        def get(id):
+            return None
+
+    class Role(object):
+        ADMIN = 'admin'
+
+    @staticmethod
+    def PackageRole(**kwargs):
+        return None
+
+
+class FakeActions(object):
+    '''
+    Stand-in for the CKAN logic layer that counts the action calls
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        self.update = self
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def get_action(self, name):
+        def call(context, data_dict):
+            self.count(name)
+            return {'id': data_dict.get('id') or str(uuid4())}
+        return call
+
+    def term_translation_update_many(self, context, data_dict):
+        self.count('term_translation_update_many')
+
+
+def peak_memory():
+    '''
+    Return the peak resident memory of the process in MB
+    '''
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return usage / (1024.0 * 1024.0)
+    return usage / 1024.0
+
+
+def setup_harvester(options, catalogue, files, cache_dir):
+    '''
+    Return a ZhstatHarvester wired to the S3, database and CKAN
+    stand-ins, together with the stand-ins
+    '''
+    prefix = ZhstatHarvester.DATA_PATH
+    bucket_files = dict((prefix + k, v) for k, v in files.items())
+    bucket_files[prefix + ZhstatHarvester.METADATA_FILE_NAME] = catalogue
+    bucket = FakeS3(
+        'benchmark',
+        bucket_files,
+        options.latency,
+        options.bandwidth
+    )
+    session = FakeSession()
+    actions = FakeActions()
+
+    zhstatharvester.Session = session
+    zhstatharvester.HarvestObject = FakeHarvestObject
+    zhstatharvester.HarvestObjectExtra = dict
+    zhstatharvester.model = FakeModel
+    zhstatharvester.get_action = actions.get_action
+    zhstatharvester.action = actions
+
+    if options.storage == 'local':
+        # A mirror of the bucket in the cache directory
+        mirror = os.path.join(cache_dir, 'mirror')
+        for name, content in bucket_files.items():
+            path = os.path.join(mirror, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as mirror_file:
+                mirror_file.write(content)
+        storage = get_storage(
+            'local',
+            path=mirror,
+            prefix=prefix,
+            base_url='http://%s.s3.amazonaws.com/' % bucket.name
+        )
+    else:
+        storage = get_storage(
+            options.storage,
+            bucket_name=bucket.name,
+            access_key=None,
+            secret_key=None,
+            prefix=prefix
+        )
+        storage.bucket = bucket
+        storage._get_thread_bucket = lambda: bucket
+
+    harvester = ZhstatHarvester()
+    harvester.CACHE_DIR = cache_dir
+    harvester.S3_LISTING = not options.no_listing
+    harvester.USE_MANIFEST = options.manifest
+    harvester.CHUNKED_GATHER = options.chunked
+    publisher = FakePublisher()
+    harvester._get_fetch_publisher = lambda: publisher
+    harvester.storage = storage
+    harvester._get_current_fingerprints = lambda harvest_job: {}
+    harvester._get_current_packages = lambda harvest_job: {}
+    harvester._last_job_failed = lambda harvest_job: False
+    harvester._create_or_update_package = (
+        lambda package_dict, harvest_object: actions.count('package_update')
+    )
+    return harvester, bucket, session, actions, publisher
+
+
+def timed_method(harvester, name, timings):
+    '''
+    Replace a method of the harvester by one that adds up its run time
+    '''
+    method = getattr(harvester, name)
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings[name] = timings.get(name, 0.0) + time.time() - start
+    setattr(harvester, name, wrapper)
+
+
+def run(options):
+    catalogue, files = generate_catalogue(
+        options.datasets,
+        options.languages,
+        options.resources
+    )
+    print 'Catalogue: %s datasets, %s languages, %s resources each, ' \
+        '%.1f MB metadata.xml' % (
+            options.datasets,
+            options.languages,
+            options.resources,
+            len(catalogue) / (1024.0 * 1024.0)
+        )
+
+    for run_number in range(options.repeat):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            harvester, bucket, session, actions, publisher = setup_harvester(
+                options, catalogue, files, cache_dir
+            )
+            timings = {}
+            if options.manifest:
+                # Written ahead of the gather like by the paster command
+                harvester.update_manifest()
+                bucket.requests.clear()
+            timed_method(harvester, '_generate_metadata', timings)
+            gc.collect()
+
+            start = time.time()
+            harvester.gather_stage(FakeHarvestObject(source_id='bench'))
+            gather_time = time.time() - start
+            gather_memory = peak_memory()
+            first_published = (publisher.first_sent or start) - start
+
+            objects = session.objects
+            start = time.time()
+            for obj in objects:
+                harvester.import_stage(obj)
+            import_time = time.time() - start
+        finally:
+            shutil.rmtree(cache_dir)
+
+        print ''
+        print 'Run %s' % (run_number + 1)
+        report('gather_stage', gather_time, len(objects))
+        report(
+            '_generate_metadata',
+            timings.get('_generate_metadata', 0.0),
+            options.datasets
+        )
+        report('import_stage', import_time, len(objects))
+        if options.chunked:
+            print '  first fetch message: %8.3f s  (%s published)' % (
+                first_published,
+                len(publisher.messages)
+            )
+        print '  S3 requests:         %s' % format_counts(bucket.requests)
+        print '  CKAN actions:        %s' % format_counts(actions.calls)
+        print '  DB commits:          %s' % session.commits
+        print '  peak memory:         %.1f MB (after gather %.1f MB)' % (
+            peak_memory(),
+            gather_memory
+        )
+
+
+def report(name, seconds, count):
+    rate = count / seconds if seconds else 0
+    print '  %-21s%8.3f s  %8.1f datasets/s' % (name + ':', seconds, rate)
+
+
+def format_counts(counts):
+    return ', '.join(
+        '%s=%s' % (name, count) for name, count in sorted(counts.items())
+    ) or '-'
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--datasets', type='int', default=1000)
+    parser.add_option('--languages', type='int', default=4)
+    parser.add_option('--resources', type='int', default=2)
+    parser.add_option('--repeat', type='int', default=1)
+    parser.add_option('--no-listing', action='store_true', default=False,
+                      help='Probe every file instead of listing the bucket')
+    parser.add_option('--storage', default='s3',
+                      help='Storage backend (s3, s3-concurrent or local)')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='Seconds every S3 request takes')
+    parser.add_option('--bandwidth', type='float', default=0.0,
+                      help='MB/s downloaded from S3 (default: unlimited)')
+    parser.add_option('--manifest', action='store_true', default=False,
+                      help='Read the files from a manifest written ahead')
+    parser.add_option('--chunked', action='store_true', default=False,
+                      help='Publish the harvest objects in chunks')
+    options, args = parser.parse_args()
+    run(options)
+
+
+if __name__ == '__main__':
+    main()
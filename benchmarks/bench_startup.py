@@ -0,0 +1,88 @@
+#coding: utf-8
+'''
+Startup benchmark for the plugin and paster command modules
+
+Imports each entry point module in a fresh interpreter, reports the
+median import time and which heavy dependencies got loaded on the way.
+To compare with an older version, check it out into a separate worktree
+and pass it with --path:
+
+    git worktree add /tmp/zhstat-old <revision>
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --path /tmp/zhstat-old
+'''
+
+import os
+import sys
+import json
+import optparse
+import subprocess
+
+MODULES = [
+    'ckanext.zhstat.plugins',
+    'ckanext.zhstat.harvesters',
+    'ckanext.zhstat.commands.harvester',
+]
+
+HEAVY_MODULES = [
+    'boto',
+    'lxml.etree',
+    'multiprocessing.pool',
+    'ckan.lib.search',
+    'ckan.lib.helpers',
+    'ckan.model',
+    'ckan.logic',
+]
+
+MEASURE = '''
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+print json.dumps([elapsed, [m for m in %r if m in sys.modules]])
+'''
+
+
+def measure(path, module, repeat):
+    '''
+    Return the median import time of module and the heavy modules it
+    loaded
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p]
+    )
+    times = []
+    loaded = []
+    for i in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', MEASURE % (module, HEAVY_MODULES)],
+            env=env,
+            cwd=path
+        )
+        elapsed, loaded = json.loads(output.strip().splitlines()[-1])
+        times.append(elapsed)
+    times.sort()
+    return times[len(times) // 2], loaded
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__)
+    parser.add_option('--path', default=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))
+    ), help='Checkout of ckanext-zhstat to measure')
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    print 'Measuring %s (median of %s runs)' % (options.path, options.repeat)
+    for module in MODULES:
+        elapsed, loaded = measure(options.path, module, options.repeat)
+        print '  %-36s %7.1f ms  loads: %s' % (
+            module,
+            elapsed * 1000,
+            ', '.join(loaded) or '-'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
 import sys
 import re
+import time
 from pprint import pprint
 
-from ckan import model
-from ckan.logic import get_action, ValidationError
-
 from ckan.lib.cli import CkanCommand
 
+import logging
+log = logging.getLogger(__name__)
+
+# ckan.model, ckan.logic and the harvester modules are imported by the
+# methods that need them, after the config has been loaded. This keeps
+# simple invocations (and printing the usage) fast.
+
 class Harvester(CkanCommand):
     '''Harvests remotely mastered metadata
 
@@ -34,16 +39,27 @@ class Harvester(CkanCommand):
       harvester run
         - runs harvest jobs
 
-      harvester gather_consumer
+      harvester [--batch-size={n}] [--prefetch={n}] [--max-wait={seconds}] gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+      harvester [--batch-size={n}] [--prefetch={n}] [--max-wait={seconds}] [--workers={n}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          With --workers a pool of {n} consumer processes is forked, each with
+          its own database session and queue channel. Workers that crash are
+          restarted, SIGTERM stops them after their current message.
+
+          With --batch-size the consumer takes up to {n} messages (or as many as
+          arrive within --max-wait seconds) and acknowledges them with a single
+          ack. Every message is still processed and committed on its own.
+          --prefetch sets how many unacknowledged messages the queue delivers
+          in advance (defaults to the batch size). Batches need pika >= 0.10,
+          the consumer refuses --batch-size with other queue backends.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
-      harvester [-j] [--segments={segments}] import [{source-id}]
+      harvester [-j] [--segments={segments}] [--import-workers={n}] import [{source-id}]
         - perform the import stage with the last fetched objects, optionally belonging to a certain source.
           Please note that no objects will be fetched from the remote server. It will only affect
           the last fetched objects already present in the database.
@@ -54,12 +70,28 @@ class Harvester(CkanCommand):
           The --segments flag allows to define a string containing hex digits that represent which of
           the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f
 
+          With --import-workers the segments are split across a pool of {n} forked
+          processes that import them in parallel, each with its own database
+          session. Creating groups and organizations is serialized between them.
+
       harvester job-all
         - create new harvest jobs for all active sources.
 
       harvester reindex
         - reindexes the harvest source datasets
 
+      harvester manifest
+        - records the size, etag, checksum, content type and modification date
+          of the harvested files in the manifest of the harvesters, only the
+          files that changed since the last run are looked up again
+
+    The run, import, gather_consumer and fetch_consumer commands accept
+    --profile to run under cProfile. The stats are written to the directory
+    given with --profile-output (default: the current directory), one pstats
+    file per command run or, for the consumers, per harvest job. They can be
+    inspected with python -m pstats or turned into flame graphs with tools
+    like flameprof or snakeviz.
+
     The commands should be run from the ckanext-harvest directory and expect
     a development.ini file to be present. Most of the time you will
     specify the config explicitly though::
@@ -85,20 +117,50 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
-    def command(self):
-        self._load_config()
+        self.parser.add_option('--batch-size', dest='batch_size',
+            default=1, type='int', help='Number of queue messages to process per batch')
 
-        # We'll need a sysadmin user to perform most of the actions
-        # We will use the sysadmin site user (named as the site_id)
-        context = {'model':model,'session':model.Session,'ignore_auth':True}
-        self.admin_user = get_action('get_site_user')(context,{})
+        self.parser.add_option('--prefetch', dest='prefetch',
+            default=None, type='int', help='Number of unacknowledged messages to prefetch')
 
+        self.parser.add_option('--max-wait', dest='max_wait',
+            default=10.0, type='float', help='Seconds to wait for a batch to fill up')
 
-        print ''
+        self.parser.add_option('--workers', dest='workers',
+            default=1, type='int', help='Number of fetch consumer processes')
+
+        self.parser.add_option('--import-workers', dest='import_workers',
+            default=1, type='int', help='Number of processes importing harvest objects')
+
+        self.parser.add_option('--profile', dest='profile',
+            action='store_true', default=False, help='Profile the command with cProfile')
+
+        self.parser.add_option('--profile-output', dest='profile_output',
+            default='.', help='Directory to write the profiles to')
 
+    _admin_user = None
+
+    @property
+    def admin_user(self):
+        # We'll need a sysadmin user to perform most of the actions
+        # We will use the sysadmin site user (named as the site_id)
+        # It is only looked up (or created) by the commands that need it
+        if self._admin_user is None:
+            from ckan import model
+            from ckan.logic import get_action
+            context = {'model':model,'session':model.Session,'ignore_auth':True}
+            self._admin_user = get_action('get_site_user')(context,{})
+        return self._admin_user
+
+    def command(self):
         if len(self.args) == 0:
             self.parser.print_usage()
             sys.exit(1)
+
+        self._load_config()
+
+        print ''
+
         cmd = self.args[0]
         if cmd == 'source':
             self.create_harvest_source()
@@ -111,21 +173,26 @@ class Harvester(CkanCommand):
         elif cmd == 'jobs':
             self.list_harvest_jobs()
         elif cmd == 'run':
-            self.run_harvester()
+            self.profiled('run', self.run_harvester)
         elif cmd == 'gather_consumer':
             import logging
             from ckanext.harvest.queue import get_gather_consumer, gather_callback
             logging.getLogger('amqplib').setLevel(logging.INFO)
             consumer = get_gather_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.gather'):
-                gather_callback(consumer, method, header, body)
+            self.consume(consumer, 'ckan.harvest.gather',
+                self.profiled_callback('gather', gather_callback))
         elif cmd == 'fetch_consumer':
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
-            from ckanext.harvest.queue import get_fetch_consumer, fetch_callback
-            consumer = get_fetch_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.fetch'):
-               fetch_callback(consumer, method, header, body)
+            if self.options.workers > 1:
+                from ckan import model
+                from ckanext.zhstat.commands.workers import run_workers
+                # Don't share database connections with the workers
+                model.Session.remove()
+                model.meta.engine.dispose()
+                run_workers(self.options.workers, self.fetch_consumer)
+            else:
+                self.fetch_consumer()
         elif cmd == 'purge_queues':
             from ckanext.harvest.queue import purge_queues
             purge_queues()
@@ -133,14 +200,17 @@ class Harvester(CkanCommand):
             self.initdb()
         elif cmd == 'import':
             self.initdb()
-            self.import_stage()
+            self.profiled('import', self.import_stage)
         elif cmd == 'job-all':
             self.create_harvest_job_all()
         elif cmd == 'harvesters-info':
+            from ckan.logic import get_action
             harvesters_info = get_action('harvesters_info_show')()
             pprint(harvesters_info)
         elif cmd == 'reindex':
             self.reindex()
+        elif cmd == 'manifest':
+            self.update_manifests()
         else:
             print 'Command %s not recognized' % cmd
 
@@ -153,7 +223,81 @@ class Harvester(CkanCommand):
 
         print 'DB tables created'
 
+    def fetch_consumer(self):
+        from ckanext.harvest.queue import get_fetch_consumer, fetch_callback
+        consumer = get_fetch_consumer()
+        self.consume(consumer, 'ckan.harvest.fetch',
+            self.profiled_callback('fetch', fetch_callback))
+
+    def profiled(self, name, func):
+        if not self.options.profile:
+            return func()
+        from ckanext.zhstat.commands.profiling import run_profiled
+        return run_profiled(self.options.profile_output, name, func)
+
+    def profiled_callback(self, name, callback):
+        if not self.options.profile:
+            return callback
+        import signal
+        from ckanext.zhstat.commands.profiling import JobProfiler
+        from ckanext.zhstat.commands.workers import WorkerState
+        # Stop after the current message, so the profile is written
+        signal.signal(signal.SIGTERM, WorkerState.handle_signal)
+        # There is one gather message per job
+        return JobProfiler(self.options.profile_output, name, callback,
+            single_message=(name == 'gather'))
+
+    def consume(self, consumer, queue, callback):
+        try:
+            self.consume_messages(consumer, queue, callback)
+        finally:
+            # Worker processes end with os._exit(), which skips atexit
+            if hasattr(callback, 'dump'):
+                callback.dump()
+
+    def consume_messages(self, consumer, queue, callback):
+        from ckanext.zhstat.commands.workers import WorkerState
+        batch_size = self.options.batch_size
+        if batch_size <= 1:
+            for method, header, body in consumer.consume(queue=queue):
+                WorkerState.start_message()
+                callback(consumer, method, header, body)
+                WorkerState.end_message()
+            return
+
+        consumer.basic_qos(prefetch_count=self.options.prefetch or batch_size)
+        try:
+            # pika >= 0.10 yields None after max_wait seconds without a message
+            messages = consumer.consume(queue=queue,
+                inactivity_timeout=self.options.max_wait)
+        except TypeError:
+            # Without it a partial batch would wait for the next message
+            print 'The queue backend does not support --batch-size'
+            sys.exit(1)
+
+        batch = BatchChannel(consumer)
+        count = 0
+        started = None
+        for message in messages:
+            if message is not None:
+                method, header, body = message
+                if started is None:
+                    started = time.time()
+                WorkerState.start_message()
+                callback(batch, method, header, body)
+                count += 1
+            if count >= batch_size or (started is not None and
+                    time.time() - started >= self.options.max_wait):
+                batch.flush()
+                count = 0
+                started = None
+            if count == 0:
+                # Stops the worker here if a SIGTERM arrived during the batch
+                WorkerState.end_message()
+
     def create_harvest_source(self):
+        from ckan import model
+        from ckan.logic import get_action, ValidationError
 
         if len(self.args) >= 2:
             url = unicode(self.args[1])
@@ -217,6 +361,9 @@ class Harvester(CkanCommand):
            raise e
 
     def remove_harvest_source(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         if len(self.args) >= 2:
             source_id = unicode(self.args[1])
         else:
@@ -227,6 +374,9 @@ class Harvester(CkanCommand):
         print 'Removed harvest source: %s' % source_id
 
     def list_harvest_sources(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         if len(self.args) >= 2 and self.args[1] == 'all':
             data_dict = {}
             what = 'harvest source'
@@ -234,12 +384,15 @@ class Harvester(CkanCommand):
             data_dict = {'only_active':True}
             what = 'active harvest source'
 
-        context = {'model': model,'session':model.Session, 'user': self.admin_user['name']}
+        context = {'model': model,'session':model.Session, 'ignore_auth': True}
         sources = get_action('harvest_source_list')(context,data_dict)
         self.print_harvest_sources(sources)
         self.print_there_are(what=what, sequence=sources)
 
     def create_harvest_job(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         if len(self.args) >= 2:
             source_id = unicode(self.args[1])
         else:
@@ -254,25 +407,38 @@ class Harvester(CkanCommand):
         self.print_there_are('harvest job', jobs, condition=u'New')
 
     def list_harvest_jobs(self):
-        context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
+        from ckan import model
+        from ckan.logic import get_action
+
+        context = {'model': model, 'ignore_auth': True, 'session':model.Session}
         jobs = get_action('harvest_job_list')(context,{})
 
         self.print_harvest_jobs(jobs)
         self.print_there_are(what='harvest job', sequence=jobs)
 
     def run_harvester(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
         jobs = get_action('harvest_jobs_run')(context,{})
 
         #print 'Sent %s jobs to the gather queue' % len(jobs)
 
     def import_stage(self):
+        from ckan import model
+        from ckan.logic import get_action
 
         if len(self.args) >= 2:
             source_id = unicode(self.args[1])
         else:
             source_id = None
 
+        if self.options.import_workers > 1:
+            count = self.import_parallel(source_id)
+            print '%s objects reimported' % count
+            return
+
         context = {'model': model, 'session':model.Session, 'user': self.admin_user['name'],
                    'join_datasets': not self.options.no_join_datasets,
                    'segments': self.options.segments}
@@ -280,18 +446,60 @@ class Harvester(CkanCommand):
 
         objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
 
+        # Index the packages whose search indexing was deferred
+        flush_indexes()
+
         print '%s objects reimported' % len(objs)
 
+    def import_parallel(self, source_id):
+        import multiprocessing
+        from ckan import model
+
+        segments = self.options.segments or '0123456789abcdef'
+        workers = min(self.options.import_workers, len(segments))
+        tasks = [(source_id, self.admin_user['name'],
+                  not self.options.no_join_datasets, segments[i::workers])
+                 for i in range(workers)]
+
+        # Inherited by the workers, so that only one of them at a time
+        # looks up or creates a group or the organization
+        set_creation_lock(multiprocessing.Lock())
+
+        # Don't share database connections with the workers
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(import_segments, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return sum(counts)
+
     def create_harvest_job_all(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
         jobs = get_action('harvest_job_create_all')(context,{})
         print 'Created %s new harvest jobs' % len(jobs)
 
     def reindex(self):
+        from ckan import model
+        from ckan.logic import get_action
+
         context = {'model': model, 'user': self.admin_user['name']}
         get_action('harvest_sources_reindex')(context,{})
 
 
+    def update_manifests(self):
+        for harvester in harvester_plugins():
+            if hasattr(harvester, 'update_manifest'):
+                changed, removed = harvester.update_manifest()
+                print '%s: %s files added or changed, %s removed' % (
+                    harvester.info()['name'], changed, removed)
+
     def print_harvest_sources(self, sources):
         if sources:
             print ''
@@ -340,3 +548,67 @@ class Harvester(CkanCommand):
     def is_singular(self, sequence):
         return len(sequence) == 1
 
+
+def harvester_plugins():
+    from ckan.plugins import PluginImplementations
+    from ckanext.harvest.interfaces import IHarvester
+    return PluginImplementations(IHarvester)
+
+
+def flush_indexes():
+    '''Index the packages whose search indexing was deferred by the
+    harvesters'''
+    for harvester in harvester_plugins():
+        if hasattr(harvester, 'flush_index'):
+            harvester.flush_index()
+
+
+def set_creation_lock(lock):
+    '''Replace the lock the harvesters hold while creating groups and
+    organizations'''
+    for harvester in harvester_plugins():
+        if hasattr(harvester, 'creation_lock'):
+            harvester.creation_lock = lock
+
+
+def import_segments(task):
+    '''Import the harvest objects of some segments in a pool worker and
+    return their number'''
+    from ckan import model
+    from ckan.logic import get_action
+
+    source_id, user_name, join_datasets, segments = task
+    context = {'model': model, 'session': model.Session, 'user': user_name,
+               'join_datasets': join_datasets, 'segments': segments}
+    try:
+        objs = get_action('harvest_objects_import')(context,
+            {'source_id': source_id})
+        flush_indexes()
+    finally:
+        model.Session.remove()
+    log.info('Imported %s objects of the segments %s' % (len(objs), segments))
+    return len(objs)
+
+
+class BatchChannel(object):
+    '''Wraps a queue consumer channel and collects the acknowledgements of
+    the messages passed to the callbacks, so they can be sent for a whole
+    batch at once.
+    '''
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.delivery_tags = []
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def basic_ack(self, delivery_tag=0, *args, **kwargs):
+        self.delivery_tags.append(delivery_tag)
+
+    def flush(self):
+        if not self.delivery_tags:
+            return
+        self.channel.basic_ack(delivery_tag=max(self.delivery_tags),
+            multiple=True)
+        self.delivery_tags = []
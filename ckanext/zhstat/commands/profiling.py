@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import atexit
+import cProfile
+
+from ckan import model
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def profile_path(output_dir, name):
+    '''
+    Return a new path for a profile in output_dir
+    '''
+    return os.path.join(
+        output_dir,
+        '%s-%s-%s.pstats' % (name, time.strftime('%Y%m%d-%H%M%S'),
+                             os.getpid())
+    )
+
+
+def run_profiled(output_dir, name, func, *args, **kwargs):
+    '''
+    Run func under cProfile and write the stats to output_dir
+    '''
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        path = profile_path(output_dir, name)
+        profile.dump_stats(path)
+        log.info('Wrote profile to %s' % path)
+
+
+class JobProfiler(object):
+    '''
+    Profiles a queue consumer callback and writes one profile per harvest
+    job. Messages of the same job are added up until the last message of
+    the job has been handled (every message if single_message is true),
+    a message of another job arrives or the consumer stops.
+    '''
+
+    def __init__(self, output_dir, name, callback, single_message=False):
+        self.output_dir = output_dir
+        self.name = name
+        self.callback = callback
+        self.single_message = single_message
+        self.job_id = None
+        self.profile = None
+        atexit.register(self.dump)
+
+    def __call__(self, channel, method, header, body):
+        job_id = self.get_job_id(body)
+        if job_id != self.job_id:
+            self.dump()
+            self.job_id = job_id
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        try:
+            return self.profile.runcall(
+                self.callback,
+                channel,
+                method,
+                header,
+                body
+            )
+        finally:
+            if self.single_message or self.job_is_done():
+                self.dump()
+
+    def job_is_done(self):
+        if self.job_id is None:
+            return False
+        from ckanext.zhstat.harvesters.zhstatharvester import job_is_done
+        try:
+            return job_is_done(self.job_id)
+        finally:
+            model.Session.remove()
+
+    def get_job_id(self, body):
+        try:
+            message = json.loads(body)
+        except ValueError:
+            return None
+        if 'harvest_job_id' in message:
+            return message['harvest_job_id']
+
+        from ckanext.harvest.model import HarvestObject
+        row = model.Session.query(HarvestObject.harvest_job_id) \
+            .filter(HarvestObject.id == message.get('harvest_object_id')) \
+            .first()
+        return row[0] if row else None
+
+    def dump(self):
+        if self.profile is None:
+            return
+        path = profile_path(
+            self.output_dir,
+            '%s-%s' % (self.name, self.job_id or 'unknown')
+        )
+        self.profile.dump_stats(path)
+        log.info('Wrote profile of job %s to %s' % (self.job_id, path))
+        self.profile = None
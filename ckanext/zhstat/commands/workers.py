@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import errno
+import signal
+
+import logging
+log = logging.getLogger(__name__)
+
+# Workers that die sooner than this after being started are restarted with
+# a delay, so a broken configuration doesn't end in a fork loop
+MIN_UPTIME = 5
+
+
+class WorkerState(object):
+    '''
+    Shutdown state of a worker process. A SIGTERM received while a message
+    is being processed only stops the worker once the message is done.
+    '''
+    busy = False
+    stopping = False
+
+    @classmethod
+    def handle_signal(cls, signum, frame):
+        if cls.busy:
+            cls.stopping = True
+        else:
+            sys.exit(0)
+
+    @classmethod
+    def start_message(cls):
+        cls.busy = True
+
+    @classmethod
+    def end_message(cls):
+        cls.busy = False
+        if cls.stopping:
+            sys.exit(0)
+
+
+def run_workers(count, target):
+    '''
+    Fork count worker processes that each run target() and supervise
+    them: workers that exit or crash are restarted, SIGTERM or SIGINT
+    stop all workers gracefully and return.
+    '''
+    workers = {}
+    started = {}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def spawn(number):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, WorkerState.handle_signal)
+            signal.signal(signal.SIGINT, WorkerState.handle_signal)
+            exit_code = 1
+            try:
+                target()
+                exit_code = 0
+            except SystemExit, detail:
+                exit_code = detail.code or 0
+            except Exception:
+                log.exception('Worker %s failed' % number)
+            finally:
+                # Never return into the code of the parent process
+                os._exit(exit_code)
+        workers[pid] = number
+        started[number] = time.time()
+        log.info('Started worker %s (pid %s)' % (number, pid))
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for number in range(count):
+        spawn(number)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except OSError, detail:
+            if detail.errno == errno.EINTR:
+                continue
+            raise
+        number = workers.pop(pid, None)
+        if number is None:
+            continue
+        if stopping:
+            log.info('Worker %s (pid %s) stopped' % (number, pid))
+            continue
+
+        log.warning('Worker %s (pid %s) exited with status %s, restarting'
+                    % (number, pid, status))
+        if time.time() - started[number] < MIN_UPTIME:
+            time.sleep(MIN_UPTIME)
+        if not stopping:
+            spawn(number)
@@ -0,0 +1,76 @@
+'''
+Compact serialization of the harvest object content
+
+Most of the content of a dataset are its term translations, and their
+terms are the values of the base language, repeated for every other
+language. encode() keeps every term only once in a list and writes the
+translations as [lang_code, term index, term_translation] rows, without
+the whitespace and the escaped non-ASCII characters of the default JSON.
+Payloads larger than compress_size are compressed with zlib as well.
+
+decode() reads this format as well as the plain JSON content of harvest
+objects gathered before.
+'''
+
+import json
+import zlib
+import base64
+
+FORMAT_VERSION = 1
+COMPRESSED_PREFIX = 'z:'
+
+
+def encode(metadata, compress_size=0):
+    '''
+    Return the compact serialization of the metadata of a dataset. It is
+    compressed if it is longer than compress_size (and compress_size is
+    not 0).
+    '''
+    data = dict(metadata, _v=FORMAT_VERSION)
+    if 'translations' in data:
+        terms = []
+        term_index = {}
+        rows = []
+        for translation in data['translations']:
+            term = translation['term']
+            if term not in term_index:
+                term_index[term] = len(terms)
+                terms.append(term)
+            rows.append([
+                translation['lang_code'],
+                term_index[term],
+                translation['term_translation']
+            ])
+        data['translations'] = {'terms': terms, 'rows': rows}
+
+    # Umlauts and accents are kept as they are instead of escaped
+    content = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+    if compress_size and len(content) > compress_size:
+        content = COMPRESSED_PREFIX + base64.b64encode(
+            zlib.compress(content.encode('utf-8'))
+        )
+    return unicode(content)
+
+
+def decode(content):
+    '''
+    Return the metadata of a dataset from the content of a harvest object
+    '''
+    if content.startswith(COMPRESSED_PREFIX):
+        content = zlib.decompress(
+            base64.b64decode(content[len(COMPRESSED_PREFIX):])
+        ).decode('utf-8')
+    metadata = json.loads(content)
+    if metadata.pop('_v', None) is None:
+        # Plain JSON content
+        return metadata
+
+    if 'translations' in metadata:
+        terms = metadata['translations']['terms']
+        metadata['translations'] = [
+            {'lang_code': lang_code, 'term': terms[term],
+             'term_translation': term_translation}
+            for lang_code, term, term_translation
+            in metadata['translations']['rows']
+        ]
+    return metadata
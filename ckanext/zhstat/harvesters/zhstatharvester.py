@@ -1,27 +1,86 @@
 #coding: utf-8
 
 import os
-from lxml import etree
-from uuid import uuid4
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+import re
+import time
+import json
+import calendar
+import hashlib
+import uuid
+import datetime
+from email.utils import parsedate_tz, mktime_tz
 import tempfile
+import threading
+from contextlib import contextmanager
 
 from ckan import model
-from ckan.model import Session, Package
-from ckan.logic import get_action, action
-from ckan.lib.helpers import json
+from ckan.model import Session, Package, PACKAGE_NAME_MAX_LENGTH
+from ckan.logic import get_action, action, NotFound
 from ckanext.harvest.harvesters.base import munge_tag
 from ckan.lib.munge import munge_title_to_name
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject, \
+    HarvestObjectExtra
 from ckanext.harvest.harvesters import HarvesterBase
+from ckanext.zhstat.metrics import metrics
+from ckanext.zhstat import content as harvest_content
+from ckanext.zhstat.storage import get_storage
+from ckanext.zhstat.manifest import Manifest
 
 from pylons import config
+from paste.deploy.converters import asbool
 
 import logging
 log = logging.getLogger(__name__)
 
+NAME_SEPARATORS = re.compile(r'[-_]+')
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+DATA_ELEMENTS = 'data'
+RESOURCE_NAMES = 'data/resources/resource/name/text()'
+
+# Resource fields that describe the file, not the dataset
+FILE_FIELDS = ('size', 'hash', 'last_modified', 'mimetype')
+
+# The harvest object segments of the 'harvester import' command
+SEGMENTS = '0123456789abcdef'
+
+# lxml and the search index are only imported on the code paths that
+# use them, so loading the plugin or the paster command stays cheap
+_xpaths = {}
+
+
+def compiled_xpath(expression):
+    '''
+    Return the compiled XPath for an expression, it is compiled on first use
+    '''
+    if expression not in _xpaths:
+        from lxml import etree
+        _xpaths[expression] = etree.XPath(expression, smart_strings=False)
+    return _xpaths[expression]
+
+
+def segment_id(segment):
+    '''
+    Return a new harvest object id in the given segment, i.e. the first
+    digit of the MD5 hex digest of the id is the segment
+    '''
+    while True:
+        object_id = unicode(uuid.uuid4())
+        if hashlib.md5(object_id).hexdigest()[0] == segment:
+            return object_id
+
+
+def parse_last_modified(value):
+    '''
+    Return the seconds since the epoch of a last modification date, either
+    in the ISO 8601 format of bucket listings or the RFC 1123 format of
+    HEAD responses
+    '''
+    if ',' in value:
+        return mktime_tz(parsedate_tz(value))
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
 
 class ZhstatHarvester(HarvesterBase):
     '''
@@ -33,11 +92,79 @@ class ZhstatHarvester(HarvesterBase):
     BUCKET_NAME = config.get('ckanext.zhstat.s3_bucket')
     DATA_PATH = 'Kanton-ZH/Statistik/'
     METADATA_FILE_NAME = 'metadata.xml'
+    METADATA_STATE_NAME = 'metadata.json'
+    RESOURCE_STATE_NAME = 'resources.json'
+    MANIFEST_NAME = 'manifest.sqlite'
+
+    # Local directory to keep the last metadata file between gathers
+    CACHE_DIR = config.get(
+        'ckanext.zhstat.cache_dir',
+        os.path.join(tempfile.gettempdir(), 'ckanext-zhstat')
+    )
 
     # Define the keys in the CKAN .ini file
     AWS_ACCESS_KEY = config.get('ckanext.zhstat.s3_key')
     AWS_SECRET_KEY = config.get('ckanext.zhstat.s3_token')
 
+    # The storage backend the files are read from, see ckanext.zhstat.storage
+    STORAGE = config.get('ckanext.zhstat.storage', 's3')
+    # Directory of the local backend, with DATA_PATH below it
+    LOCAL_PATH = config.get('ckanext.zhstat.local_path')
+    # Resource URLs of the local backend start with this
+    BASE_URL = config.get(
+        'ckanext.zhstat.base_url',
+        'http://%s.s3.amazonaws.com/' % BUCKET_NAME
+    )
+
+    # If listing the bucket is not permitted, the files are looked up with
+    # one request each, using a pool of S3_PROBE_WORKERS threads
+    S3_LISTING = asbool(config.get('ckanext.zhstat.s3_listing', True))
+    S3_PROBE_WORKERS = int(config.get('ckanext.zhstat.s3_probe_workers', 8))
+    S3_PROBE_CHUNK_SIZE = int(
+        config.get('ckanext.zhstat.s3_probe_chunk_size', 100)
+    )
+
+    # Seconds the ids of the groups and the organization are cached
+    GROUP_CACHE_TTL = int(config.get('ckanext.zhstat.group_cache_ttl', 3600))
+
+    # Don't update the search index for every imported package, but index
+    # them in batches of INDEX_BATCH_SIZE and at the end of the job
+    DEFER_INDEXING = asbool(config.get('ckanext.zhstat.defer_indexing', False))
+    INDEX_BATCH_SIZE = int(config.get('ckanext.zhstat.index_batch_size', 200))
+
+    # Seconds after which the metrics of a running import are flushed, in
+    # addition to when a worker starts importing objects of another job
+    METRICS_FLUSH_INTERVAL = int(
+        config.get('ckanext.zhstat.metrics_flush_interval', 60)
+    )
+
+    # Only update the resources whose files changed since the last gather
+    # if the metadata of a dataset didn't change
+    INCREMENTAL = asbool(config.get('ckanext.zhstat.incremental', False))
+
+    # Read the files from the manifest in CACHE_DIR written by the
+    # 'harvester manifest' command instead of listing or probing them
+    USE_MANIFEST = asbool(config.get('ckanext.zhstat.use_manifest', False))
+
+    # Delete the packages of datasets that were removed from the metadata
+    DELETE_MISSING = asbool(config.get('ckanext.zhstat.delete_missing', True))
+
+    # The content of the harvest objects is compressed if it is longer
+    # (0 disables the compression)
+    COMPRESS_CONTENT_SIZE = int(
+        config.get('ckanext.zhstat.compress_content_size', 8192)
+    )
+
+    # Number of harvest objects inserted per flush during gather
+    GATHER_BATCH_SIZE = int(
+        config.get('ckanext.zhstat.gather_batch_size', 500)
+    )
+
+    # Commit every batch and publish it to the fetch queue right away
+    # instead of returning the ids of all objects at the end of the gather.
+    # The batches are spread over the segments of the import command.
+    CHUNKED_GATHER = asbool(config.get('ckanext.zhstat.chunked_gather', False))
+
     ORGANIZATION = {
         u'de': {
             'name': u'Kanton Zürich',
@@ -83,211 +210,1299 @@ class ZhstatHarvester(HarvesterBase):
         'user': u'harvest'
     }
 
-    bucket = None
+    storage = None
+    file_index = None
+    # Files looked up by _probe_files() during the gather
+    probed_files = None
+    from_manifest = False
+    metadata_state = None
+    resource_state = None
+    translation_job_id = None
+    package_names = None
+    package_names_job_id = None
+    metrics_job_id = None
+    metrics_flushed = 0
+    written_translations = None
+    # Held while looking up or creating a group or the organization, the
+    # 'harvester import' command replaces it by a lock shared between its
+    # worker processes
+    creation_lock = threading.Lock()
 
-    def _gen_new_name(self, title, current_id=None):
+    def __init__(self, *args, **kwargs):
+        super(ZhstatHarvester, self).__init__(*args, **kwargs)
+        # Not shared between instances like class attributes
+        self.group_cache = {}
+        self.pending_index = set()
+
+    def _get_package_names(self, harvest_object):
+        '''
+        Return a dict of all package names and their ids, loaded with a
+        single query once per harvest job
+        '''
+        if (self.package_names is None
+                or harvest_object.harvest_job_id != self.package_names_job_id):
+            self.package_names = dict(
+                Session.query(Package.name, Package.id).all()
+            )
+            self.package_names_job_id = harvest_object.harvest_job_id
+        return self.package_names
+
+    def _name_is_free(self, package_names, name, current_id):
+        '''
+        Returns true if no other package than current_id has the name.
+        Names that are not in the name map are looked up in the database,
+        as other workers may have created them since the map was loaded.
+        '''
+        package_id = package_names.get(name)
+        if package_id is None:
+            package_id = Session.query(Package.id) \
+                .filter(Package.name == name) \
+                .scalar()
+            if package_id is not None:
+                package_names[name] = package_id
+        return package_id is None or package_id == current_id
+
+    def _gen_new_name(self, title, harvest_object, current_id=None):
         '''
         Creates a URL friendly name from a title
 
-        If the name already exists, it will add
-        some random characters at the end
+        If the name already exists, it will add the beginning of the MD5
+        hash of the dataset id (and a counter if needed) at the end, so
+        that the same name is generated on every harvest. Long names are
+        shortened to keep the suffix within the maximum name length.
         '''
+        name = NAME_SEPARATORS.sub('-', munge_title_to_name(title))
+        package_names = self._get_package_names(harvest_object)
 
-        name = munge_title_to_name(title).replace('_', '-')
-        while '--' in name:
-            name = name.replace('--', '-')
-        pkg_obj = Session.query(Package).filter(Package.name == name).first()
-        if pkg_obj and pkg_obj.id != current_id:
-            return name + str(uuid4())[:5]
-        else:
-            return name
+        candidate = name
+        counter = 1
+        while not self._name_is_free(package_names, candidate, current_id):
+            if current_id and counter == 1:
+                id_hash = hashlib.md5(unicode(current_id).encode('utf-8'))
+                suffix = id_hash.hexdigest()[:5]
+            else:
+                suffix = str(counter)
+            # Long titles are cut to leave room for the suffix
+            base = name[:PACKAGE_NAME_MAX_LENGTH - len(suffix) - 1]
+            candidate = '%s-%s' % (base.rstrip('-'), suffix)
+            counter += 1
+        return candidate
+
+    def _get_storage(self):
+        '''
+        Return the storage backend the files are read from
+        '''
+        if self.storage is None:
+            self.storage = get_storage(
+                self.STORAGE,
+                bucket_name=self.BUCKET_NAME,
+                access_key=self.AWS_ACCESS_KEY,
+                secret_key=self.AWS_SECRET_KEY,
+                prefix=self.DATA_PATH,
+                probe_workers=self.S3_PROBE_WORKERS,
+                path=self.LOCAL_PATH,
+                base_url=self.BASE_URL
+            )
+        return self.storage
+
+    def _get_manifest(self):
+        '''
+        Return the manifest of the files in the cache directory
+        '''
+        return Manifest(os.path.join(self.CACHE_DIR, self.MANIFEST_NAME))
+
+    def update_manifest(self):
+        '''
+        Record the size, etag, MD5 checksum, content type and modification
+        date of every file in the manifest, returns the number of added or
+        changed and of removed files
+        '''
+        if not os.path.isdir(self.CACHE_DIR):
+            os.makedirs(self.CACHE_DIR)
+        try:
+            with metrics.timer('manifest.update'):
+                return self._get_manifest().update(self._get_storage())
+        finally:
+            self._get_storage().finish()
+            metrics.flush('manifest')
+
+    def _load_manifest(self):
+        '''
+        Fill the file index from the manifest, returns false if there is
+        no manifest
+        '''
+        manifest = self._get_manifest()
+        if not manifest.exists():
+            log.warning('No manifest at %s, run the harvester manifest '
+                        'command first' % manifest.path)
+            return False
+        with metrics.timer('manifest.load'):
+            self.file_index = manifest.load()
+        log.debug('Loaded %s files from the manifest updated at %s'
+                  % (len(self.file_index), time.ctime(manifest.updated())))
+        return True
+
+    def _has_full_index(self):
+        '''
+        Returns true if the file index holds every file, not only the
+        probed ones
+        '''
+        return self.S3_LISTING or self.from_manifest
+
+    def _get_metadata_state(self):
+        '''
+        Return the ETag and Last-Modified values of the metadata file
+        processed by the last successful gather (or None)
+        '''
+        state_path = os.path.join(self.CACHE_DIR, self.METADATA_STATE_NAME)
+        metadata_file_path = os.path.join(
+            self.CACHE_DIR,
+            self.METADATA_FILE_NAME
+        )
+        # Local files are read again instead of a copy
+        if not (os.path.exists(state_path)
+                and (self._get_storage().is_local
+                     or os.path.exists(metadata_file_path))):
+            return None
+        try:
+            with open(state_path) as state_file:
+                return json.load(state_file)
+        except ValueError:
+            log.warning('Ignoring corrupt metadata state %s' % state_path)
+            return None
+
+    def _store_metadata_state(self):
+        '''
+        Remember the ETag and Last-Modified values of the metadata file
+        that was fetched, so that the next gather can skip it if it
+        didn't change
+        '''
+        if self.metadata_state is None:
+            return
+        state_path = os.path.join(self.CACHE_DIR, self.METADATA_STATE_NAME)
+        with open(state_path + '.part', 'w') as state_file:
+            json.dump(self.metadata_state, state_file)
+        os.rename(state_path + '.part', state_path)
+        log.debug('Stored metadata state %s' % self.metadata_state)
+
+    def _get_resource_state(self):
+        '''
+        Return the etags of the files and the high-water mark of their
+        modification dates recorded by the last successful gather (or None)
+        '''
+        state_path = os.path.join(self.CACHE_DIR, self.RESOURCE_STATE_NAME)
+        if not os.path.exists(state_path):
+            return None
+        try:
+            with open(state_path) as state_file:
+                return json.load(state_file)
+        except ValueError:
+            log.warning('Ignoring corrupt resource state %s' % state_path)
+            return None
+
+    def _store_resource_state(self):
+        '''
+        Remember the etags of the files seen during this gather and the
+        latest modification date among them
+        '''
+        index = self._get_file_index()
+        if not index:
+            return
+        state = {
+            'high_water_mark': max(
+                parse_last_modified(stored_file.last_modified)
+                for stored_file in index.values()
+            ),
+            'etags': dict(
+                (file_name, stored_file.etag)
+                for file_name, stored_file in index.items()
+            ),
+        }
+        state_path = os.path.join(self.CACHE_DIR, self.RESOURCE_STATE_NAME)
+        with open(state_path + '.part', 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(state_path + '.part', state_path)
+        log.debug('Stored the state of %s files, high-water mark %s'
+                  % (len(index), state['high_water_mark']))
+
+    def _file_changed(self, file_name):
+        '''
+        Returns true if the file was modified after the high-water mark of
+        the last gather or its etag differs from the recorded one
+        '''
+        state = self.resource_state
+        if state is None:
+            return True
+        stored_file = self._get_file_index().get(file_name)
+        if stored_file is None:
+            return file_name in state['etags']
+        return (
+            stored_file.etag != state['etags'].get(file_name)
+            or parse_last_modified(stored_file.last_modified) >
+            state['high_water_mark']
+        )
+
+    def _get_changed_files(self):
+        '''
+        Return the names of the files that were added, changed or removed
+        since the last gather, or None if that can't be told without
+        looking up every file
+        '''
+        if self.resource_state is None or not self._has_full_index():
+            return None
+        file_names = set(self._get_file_index())
+        file_names.update(self.resource_state['etags'])
+        return set(
+            file_name for file_name in file_names
+            if self._file_changed(file_name)
+        )
+
+    def _open_cached_metadata(self):
+        '''
+        Open the copy of the metadata file kept from the last gather
+        '''
+        if self._get_storage().is_local:
+            return self._get_storage().open_metadata(self.METADATA_FILE_NAME)
+        return open(
+            os.path.join(self.CACHE_DIR, self.METADATA_FILE_NAME),
+            'rb'
+        )
+
+    def _get_previous_job_id(self, harvest_job):
+        '''
+        Return the id of the latest previous job of the source that created
+        harvest objects (or None). Jobs without objects, e.g. whose gather
+        failed or found nothing to do, are skipped.
+        '''
+        row = Session.query(HarvestJob.id) \
+            .join(HarvestObject,
+                  HarvestObject.harvest_job_id == HarvestJob.id) \
+            .filter(HarvestJob.source_id == harvest_job.source_id) \
+            .filter(HarvestJob.id != harvest_job.id) \
+            .order_by(HarvestJob.created.desc()) \
+            .first()
+        return row[0] if row else None
 
-    def _get_s3_bucket(self):
+    def _last_job_failed(self, harvest_job):
         '''
-        Create an S3 connection to the department bucket
+        Returns true if harvest objects of the previous job of the source
+        with objects failed or were never imported
         '''
-        if self.bucket is None:
-            conn = S3Connection(self.AWS_ACCESS_KEY, self.AWS_SECRET_KEY)
-            self.bucket = conn.get_bucket(self.BUCKET_NAME)
-        return self.bucket
+        previous_job_id = self._get_previous_job_id(harvest_job)
+        if previous_job_id is None:
+            return False
+        incomplete = Session.query(HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == previous_job_id) \
+            .filter(HarvestObject.state != 'COMPLETE') \
+            .count()
+        return incomplete > 0
 
-    def _fetch_metadata(self):
-        '''Fetching the metadata file for for the Statistical Office of
-        Canton of Zurich from the S3 Bucket and save on disk
+    def _fetch_metadata(self, conditional=True):
+        '''Open the metadata file for for the Statistical Office of
+        Canton of Zurich in the storage backend for streaming
 
+        Unless conditional is false, the download is conditional on the
+        ETag and Last-Modified values of the last processed file. Returns
+        None if the file didn't change, otherwise a MetadataStream that
+        copies the file to the cache directory while it is being read
+        (unless it is a local file).
         '''
-        temp_dir = tempfile.mkdtemp()
+        self.metadata_state = None
+        if not os.path.isdir(self.CACHE_DIR):
+            os.makedirs(self.CACHE_DIR)
+
+        state = {}
+        if conditional:
+            state = self._get_metadata_state() or {}
         try:
-            metadata_file = Key(self._get_s3_bucket())
-            metadata_file.key = self.DATA_PATH + self.METADATA_FILE_NAME
+            metadata_file = self._get_storage().open_metadata(
+                self.METADATA_FILE_NAME,
+                state.get('etag'),
+                state.get('last_modified')
+            )
+            if metadata_file is None:
+                log.debug('Metadata file not modified since last gather')
+                return None
+
+            etag = metadata_file.etag.strip('"')
+            if etag == state.get('etag'):
+                metadata_file.close()
+                log.debug('Metadata file has the same ETag as last gather')
+                return None
+
+            self.metadata_state = {
+                'etag': etag,
+                'last_modified': metadata_file.last_modified,
+            }
+            if self._get_storage().is_local:
+                return metadata_file
             metadata_file_path = os.path.join(
-                temp_dir,
+                self.CACHE_DIR,
                 self.METADATA_FILE_NAME
             )
             log.debug('Saving metadata file to %s' % metadata_file_path)
-            metadata_file.get_contents_to_filename(metadata_file_path)
-            return open(metadata_file_path).read()
+            return MetadataStream(metadata_file, metadata_file_path)
         except Exception, detail:
             log.exception(detail)
             raise
 
+    def _iter_dataset_chunks(self, metadata_stream, chunk_size=1, keep=0):
+        '''
+        Parse the metadata file incrementally and yield its <dataset>
+        elements in lists of chunk_size. Processed elements are removed
+        from the tree (except the last keep chunks), so memory use doesn't
+        grow with the size of the file.
+        '''
+        from lxml import etree
+        context = etree.iterparse(
+            metadata_stream,
+            events=('end',),
+            tag='dataset',
+            encoding='utf-8'
+        )
+        chunk = []
+        processed = []
+        while True:
+            # Time spent in the parser only, not in processing the chunks
+            with metrics.timer('xml.parse'):
+                try:
+                    event, dataset = next(context)
+                except StopIteration:
+                    break
+            chunk.append(dataset)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                processed.append(chunk)
+                if len(processed) > keep:
+                    self._clear_datasets(processed.pop(0))
+                chunk = []
+        if chunk:
+            yield chunk
+            processed.append(chunk)
+        # The kept chunks may still be in use, they are released with the
+        # rest of the tree
+        for chunk in processed[:len(processed) - keep]:
+            self._clear_datasets(chunk)
+        del context
+
+    def _clear_datasets(self, datasets):
+        '''
+        Release processed <dataset> elements and their preceding siblings
+        '''
+        for dataset in datasets:
+            dataset.clear()
+        last = datasets[-1]
+        while last.getprevious() is not None:
+            del last.getparent()[0]
+
+    def _get_file_index(self):
+        '''
+        List all files below DATA_PATH once and keep their size, etag and
+        last modification date in memory, so that the resource lookups
+        don't need a request each
+        '''
+        if self.file_index is None and not self._has_full_index():
+            # Filled by _probe_files()
+            self.file_index = {}
+            self.probed_files = set()
+        elif self.file_index is None:
+            self.file_index = self._get_storage().list()
+            metrics.incr('s3.listed_files', len(self.file_index))
+            log.debug('Indexed %s files' % len(self.file_index))
+        return self.file_index
+
+    def _iter_probed_chunks(self, metadata_stream):
+        '''
+        Yield the <dataset> elements in chunks of S3_PROBE_CHUNK_SIZE once
+        their files have been looked up. The files of the next chunk are
+        looked up while a chunk is being processed.
+        '''
+        chunks = self._iter_dataset_chunks(
+            metadata_stream,
+            self.S3_PROBE_CHUNK_SIZE,
+            keep=1
+        )
+        previous = previous_lookup = None
+        for datasets in chunks:
+            lookup = self._probe_files(datasets)
+            if previous is not None:
+                self._add_probed_files(previous_lookup)
+                yield previous
+            previous, previous_lookup = datasets, lookup
+        if previous is not None:
+            self._add_probed_files(previous_lookup)
+            yield previous
+
+    def _add_probed_files(self, lookup):
+        '''
+        Wait for a lookup started by _probe_files() and add the files that
+        exist to the index
+        '''
+        if lookup is not None:
+            self._get_file_index().update(lookup.get())
+
+    def _probe_files(self, datasets):
+        '''
+        Start looking up all files of the given datasets that are not in
+        the index yet in parallel, returns the pending lookup (or None)
+        '''
+        index = self._get_file_index()
+        file_names = []
+        for dataset in datasets:
+            for file_name in compiled_xpath(RESOURCE_NAMES)(dataset):
+                # The lookup of the previous chunk may still be pending,
+                # and missing files are not in the index
+                if (file_name not in index
+                        and file_name not in self.probed_files):
+                    self.probed_files.add(file_name)
+                    file_names.append(file_name)
+        if not file_names:
+            return None
+
+        log.debug('Probing %s files' % len(file_names))
+        return self._get_storage().stat_many_async(file_names)
+
     def _file_is_available(self, file_name):
         '''
         Returns true if the file exists, false otherwise. (logs falses)
         '''
-        k = Key(self._get_s3_bucket())
-        k.key = self.DATA_PATH + file_name
-        if k.exists():
+        file_index = self._get_file_index()
+        if file_name not in file_index and self.from_manifest:
+            # Uploaded since the last update of the manifest
+            stored_file = self._get_storage().stat(file_name)
+            if stored_file is not None:
+                log.info('File is not in the manifest yet: ' + file_name)
+                file_index[file_name] = stored_file
+        if file_name in file_index:
             return True
         else:
-            log.debug('File does not exist on S3: ' + file_name)
+            log.debug('File does not exist: ' + file_name)
             return False
 
     def _get_file_url(self, file_name):
         '''
-        Generate a URL for the given S3 file name
+        Generate a URL for the given file name
         '''
-        k = Key(self._get_s3_bucket())
-        k.key = self.DATA_PATH + file_name
-        return k.generate_url(0, query_auth=False, force_http=True)
+        return self._get_storage().url(file_name)
 
     def _get_file_size(self, file_name):
         '''
-        Find the filesize for the given S3 file name
+        Find the filesize for the given file name
         '''
-        k = Key(self._get_s3_bucket())
-        k.key = self.DATA_PATH + file_name
-        return self._get_s3_bucket().lookup(k.key).size
+        return self._get_file_index()[file_name].size
 
-    def _generate_tags_array(self, dataset):
+    def _get_file_details(self, file_name):
         '''
-        All tags for a dataset into an array
+        Return the checksum, content type and modification date of a file
+        recorded in the manifest as resource fields
         '''
-        tags = []
-        try:
-            for tag in dataset.find('tags').findall('tag'):
-                tags.append(tag.text)
-        except AttributeError:
-            return tags
-
-        return tags
+        stored_file = self._get_file_index()[file_name]
+        return {
+            'hash': stored_file.md5,
+            'mimetype': stored_file.content_type,
+            'last_modified': time.strftime(
+                '%Y-%m-%dT%H:%M:%S',
+                time.gmtime(parse_last_modified(stored_file.last_modified))
+            ),
+        }
 
-    def _get_data_groups(self, data):
+    def _generate_term_translations(self, base_data, records):
         '''
-        Get group name
+        Return all the term_translations for a given dataset
         '''
-        groups = []
+        translations = []
 
-        try:
-            for tag in data.find('groups').findall('group'):
-                groups.append(tag.text)
-        except AttributeError:
-            return groups
+        for data in records:
+            if data is base_data:
+                continue
+            for base_group, group in zip(base_data.groups, data.groups):
+                translations.append({
+                    'lang_code': data.lang,
+                    'term': base_group,
+                    'term_translation': group
+                })
+            for base_tag, tag in zip(base_data.tags, data.tags):
+                translations.append({
+                    'lang_code': data.lang,
+                    'term': munge_tag(base_tag),
+                    'term_translation': munge_tag(tag)
+                })
+            for key in DataRecord.TRANSLATED_FIELDS:
+                term = getattr(base_data, key)
+                term_translation = getattr(data, key)
+                if term is not None and term_translation is not None:
+                    translations.append({
+                        'lang_code': data.lang,
+                        'term': term,
+                        'term_translation': term_translation
+                        })
 
-        return groups
+        return translations
 
-    def _generate_term_translations(self, base_data, dataset):
+    def _generate_organization_translations(self):
         '''
-        Return all the term_translations for a given dataset
+        Return the term_translations for the organization
         '''
         translations = []
-
-        for data in dataset:
-            if base_data.find('title') != data.find('title'):
-                lang = data.get('{http://www.w3.org/XML/1998/namespace}lang')
-                for base_group, group in zip(
-                        self._get_data_groups(base_data),
-                        self._get_data_groups(data)):
+        for lang, org in self.ORGANIZATION.items():
+            if lang != u'de':
+                for field in ['name', 'description']:
                     translations.append({
                         'lang_code': lang,
-                        'term': base_group,
-                        'term_translation': group
+                        'term': self.ORGANIZATION[u'de'][field],
+                        'term_translation': org[field]
                     })
-                for base_tag, tag in zip(
-                        self._generate_tags_array(base_data),
-                        self._generate_tags_array(data)):
-                    translations.append({
-                        'lang_code': lang,
-                        'term': munge_tag(base_tag),
-                        'term_translation': munge_tag(tag)
-                    })
-                for key in ['title', 'author', 'maintainer', 'description']:
-                    if (base_data.find(key) is not None
-                            and data.find(key) is not None):
-                        translations.append({
-                            'lang_code': lang,
-                            'term': base_data.find(key).text,
-                            'term_translation': data.find(key).text
-                            })
-                for lang, org in self.ORGANIZATION.items():
-                    if lang != u'de':
-                        for field in ['name', 'description']:
-                            translations.append({
-                                'lang_code': lang,
-                                'term': self.ORGANIZATION[u'de'][field],
-                                'term_translation': org[field]
-                            })
-
         return translations
 
-    def _generate_resources(self, dataset):
+    def _write_term_translations(self, context, harvest_object, translations):
+        '''
+        Write all translations that were not written during the current
+        harvest job yet with a single bulk update
+        '''
+        if harvest_object.harvest_job_id != self.translation_job_id:
+            self.translation_job_id = harvest_object.harvest_job_id
+            self.written_translations = set()
+
+        rows = []
+        keys = set()
+        for translation in translations:
+            key = (
+                translation['term'],
+                translation['lang_code'],
+                translation['term_translation']
+            )
+            if key not in self.written_translations and key not in keys:
+                keys.add(key)
+                rows.append(translation)
+
+        if rows:
+            with metrics.timer('ckan.term_translation_update_many'):
+                action.update.term_translation_update_many(
+                    context,
+                    {'data': rows}
+                )
+            metrics.incr('ckan.term_translations', len(rows))
+        self.written_translations.update(keys)
+        log.debug('Wrote %s of %s translations'
+                  % (len(rows), len(translations)))
+
+    def _generate_resources(self, records):
         '''
         Return all resources for a given dataset that are available
         '''
         resources = []
-        for data in dataset:
-            if data.find('resources') is not None:
-                for resource in data.find('resources'):
-                    if self._file_is_available(resource.find('name').text):
-                        url = self._get_file_url(resource.find('name').text)
-                        if resource.find('description') is not None:
-                            description = resource.find('description').text
-                        else:
-                            description = ''
-                        resources.append({
-                            'url': url,
-                            'name': resource.find('name').text,
-                            'format': resource.find('type').text,
-                            'description': description,
-                            'version': data.find('version').text,
-                            'size': self._get_file_size(
-                                resource.find('name').text
-                            )
-                        })
+        for data in records:
+            for name, file_format, description in data.resources:
+                if self._file_is_available(name):
+                    resource = {
+                        'url': self._get_file_url(name),
+                        'name': name,
+                        'format': file_format,
+                        'description': description,
+                        'version': data.version,
+                        'size': self._get_file_size(name)
+                    }
+                    if self.from_manifest:
+                        resource.update(self._get_file_details(name))
+                    resources.append(resource)
 
         return resources
 
-    def _generate_metadata(self, base_data, dataset):
+    def _generate_metadata(self, dataset_id, records):
         '''
         Return all the necessary metadata to be able to create a dataset
         '''
-        resources = self._generate_resources(dataset)
-        groups = self._get_data_groups(base_data)
+        # Get the german data if one is available,
+        # otherwise get the first one
+        base_data = records[0]
+        for data in records:
+            if data.lang == 'de':
+                base_data = data
+                break
+
+        resources = self._generate_resources(records)
 
-        if len(resources) != 0 and groups:
+        if len(resources) != 0 and base_data.groups:
             return {
-                'datasetID': dataset.get('id'),
-                'url': base_data.find('url').text,
-                'title': base_data.find('title').text,
-                'author': base_data.find('author').text,
-                'author_email': base_data.find('author_email').text,
-                'notes': base_data.find('description').text,
-                'maintainer': base_data.find('maintainer').text,
-                'maintainer_email': base_data.find('maintainer_email').text,
-                'license_url': base_data.find('license').get('url'),
-                'license_id': base_data.find('license').text,
-                'version': base_data.find('version').text,
+                'datasetID': dataset_id,
+                'url': base_data.url,
+                'title': base_data.title,
+                'author': base_data.author,
+                'author_email': base_data.author_email,
+                'notes': base_data.description,
+                'maintainer': base_data.maintainer,
+                'maintainer_email': base_data.maintainer_email,
+                'license_url': base_data.license_url,
+                'license_id': base_data.license,
+                'version': base_data.version,
                 'translations': self._generate_term_translations(
                     base_data,
-                    dataset
+                    records
                 ),
                 'resources': resources,
-                'tags': self._generate_tags_array(base_data),
-                'groups': groups
+                'tags': base_data.tags,
+                'groups': base_data.groups
             }
         else:
             return None
 
+    def _get_fingerprint(self, metadata):
+        '''
+        Return a stable hash over the metadata of a dataset and the
+        etags of its files
+        '''
+        index = self._get_file_index()
+        etags = [index[r['name']].etag for r in metadata['resources']]
+        return hashlib.sha1(
+            json.dumps([metadata, etags], sort_keys=True)
+        ).hexdigest()
+
+    def _get_metadata_fingerprint(self, metadata):
+        '''
+        Return a stable hash over the metadata of a dataset without the
+        properties of its files, which may change without the dataset
+        '''
+        resources = [
+            dict((key, value) for key, value in resource.items()
+                 if key not in FILE_FIELDS)
+            for resource in metadata['resources']
+        ]
+        return hashlib.sha1(
+            json.dumps(dict(metadata, resources=resources), sort_keys=True)
+        ).hexdigest()
+
+    def _get_current_fingerprints(self, harvest_job):
+        '''
+        Return the fingerprints of the current harvest objects of the
+        job's source as dicts of the extra keys and values, keyed by guid
+        '''
+        query = Session.query(
+            HarvestObject.guid,
+            HarvestObjectExtra.key,
+            HarvestObjectExtra.value
+        ) \
+            .join(
+                HarvestObjectExtra,
+                HarvestObjectExtra.harvest_object_id == HarvestObject.id
+            ) \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObjectExtra.key.in_(
+                ['fingerprint', 'metadata_fingerprint']
+            ))  # noqa
+        fingerprints = {}
+        for guid, key, value in query.all():
+            fingerprints.setdefault(guid, {})[key] = value
+        return fingerprints
+
+    def _get_resource_update(self, metadata):
+        '''
+        Return the content of a harvest object that only updates the
+        resources of a dataset whose files changed. It keeps the full
+        metadata for later re-imports with the 'harvester import' command.
+        '''
+        changed_resources = [
+            resource['name'] for resource in metadata['resources']
+            if self._file_changed(resource['name'])
+        ]
+        return dict(
+            metadata,
+            update='resources',
+            # The etags changed without a recorded state, update them all
+            changed_resources=changed_resources or [
+                resource['name'] for resource in metadata['resources']
+            ]
+        )
+
+    def _get_current_packages(self, harvest_job):
+        '''
+        Return the package ids of the current harvest objects of the job's
+        source, keyed by guid
+        '''
+        query = Session.query(HarvestObject.guid, HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_source_id == harvest_job.source_id) \
+            .filter(HarvestObject.current == True)  # noqa
+        return dict(query.all())
+
+    def _get_deletions(self, harvest_job, dataset_ids):
+        '''
+        Return harvest objects that delete the packages of the datasets
+        which are no longer in the metadata file
+        '''
+        if not dataset_ids:
+            # Rather an empty or broken file than a withdrawn catalogue
+            log.warning('No datasets found in %s, not deleting any packages'
+                        % self.METADATA_FILE_NAME)
+            return []
+        current_packages = self._get_current_packages(harvest_job)
+        return [
+            HarvestObject(
+                guid=guid,
+                job=harvest_job,
+                package_id=current_packages[guid],
+                content=harvest_content.encode(
+                    {'datasetID': guid, 'update': 'delete'}
+                ),
+                extras=[]
+            )
+            for guid in sorted(set(current_packages) - dataset_ids)
+        ]
+
+    def _save_harvest_objects(self, objects):
+        '''
+        Insert a batch of harvest objects in the current transaction and
+        return their ids
+        '''
+        Session.add_all(objects)
+        Session.flush()
+        return [obj.id for obj in objects]
+
+    def _get_fetch_publisher(self):
+        '''
+        Return a publisher for the fetch queue of ckanext-harvest
+        '''
+        from ckanext.harvest.queue import get_fetch_publisher
+        return get_fetch_publisher()
+
+    def _save_chunk(self, publisher, objects, chunk):
+        '''
+        Save a chunk of harvest objects and return their ids. If there is
+        a publisher, the chunk is committed and sent to the fetch queue,
+        with ids in segment chunk % 16 of the import command.
+        '''
+        if publisher is None:
+            return self._save_harvest_objects(objects)
+
+        segment = SEGMENTS[chunk % len(SEGMENTS)]
+        for obj in objects:
+            obj.id = segment_id(segment)
+        ids = self._save_harvest_objects(objects)
+        # The fetch consumers read them from the database
+        Session.commit()
+        metrics.incr('db.commit')
+        with metrics.timer('queue.publish'):
+            for object_id in ids:
+                publisher.send({'harvest_object_id': object_id})
+        log.debug('Published chunk %s with %s objects in segment %s'
+                  % (chunk, len(ids), segment))
+        return ids
+
+    def _gather_datasets(self, harvest_job, metadata_stream,
+                         changed_files=None):
+        '''
+        Create a harvest object for every dataset in the metadata file
+        that has resources and groups and changed since it was imported.
+        If changed_files is given, only the datasets with one of these
+        files are looked at. Otherwise the packages of the datasets that
+        are missing in the file are deleted.
+
+        With CHUNKED_GATHER the objects are published to the fetch queue
+        in chunks while the file is parsed and an empty list is returned,
+        otherwise the ids of all objects are returned.
+        '''
+        publisher = None
+        if self.CHUNKED_GATHER:
+            publisher = self._get_fetch_publisher()
+        try:
+            ids = self._gather_chunks(
+                harvest_job,
+                metadata_stream,
+                changed_files,
+                publisher
+            )
+        finally:
+            if publisher is not None:
+                publisher.close()
+        if publisher is None:
+            return ids
+
+        if self.DEFER_INDEXING and self._job_is_done(harvest_job.id):
+            # All chunks were imported before the gather finished
+            self.pending_index.update(
+                self._get_job_package_ids(harvest_job.id)
+            )
+            self.flush_index()
+        # Already in the fetch queue
+        return []
+
+    def _gather_chunks(self, harvest_job, metadata_stream, changed_files,
+                       publisher):
+        '''
+        Create the harvest objects of _gather_datasets() and save them in
+        chunks of GATHER_BATCH_SIZE, returns the ids of all of them
+        '''
+        ids = []
+        objects = []
+        dataset_ids = set()
+        unchanged = 0
+        resource_updates = 0
+        deletions = 0
+        current_fingerprints = self._get_current_fingerprints(harvest_job)
+
+        if self._has_full_index():
+            chunks = self._iter_dataset_chunks(metadata_stream)
+        else:
+            chunks = self._iter_probed_chunks(metadata_stream)
+        for datasets in chunks:
+            for dataset in datasets:
+                dataset_ids.add(dataset.get('id'))
+                if changed_files is not None and changed_files.isdisjoint(
+                        compiled_xpath(RESOURCE_NAMES)(dataset)):
+                    unchanged += 1
+                    continue
+
+                # Walk every <data> element of the dataset exactly once
+                records = [
+                    DataRecord(data)
+                    for data in compiled_xpath(DATA_ELEMENTS)(dataset)
+                ]
+                if records:
+                    with metrics.timer('gather.generate_metadata'):
+                        metadata = self._generate_metadata(
+                            dataset.get('id'),
+                            records
+                        )
+                else:
+                    metadata = None
+
+                if not metadata:
+                    log.debug(
+                        'Skipping %s since no resources or groups '
+                        'are available' % dataset.get('id')
+                    )
+                    continue
+
+                current = current_fingerprints.get(dataset.get('id'), {})
+                fingerprint = self._get_fingerprint(metadata)
+                if current.get('fingerprint') == fingerprint:
+                    log.debug('Skipping %s since it is unchanged'
+                              % dataset.get('id'))
+                    unchanged += 1
+                    continue
+
+                metadata_fingerprint = self._get_metadata_fingerprint(
+                    metadata
+                )
+                content = metadata
+                if (self.INCREMENTAL and current.get('metadata_fingerprint')
+                        == metadata_fingerprint):
+                    log.debug('Only the files of %s changed'
+                              % dataset.get('id'))
+                    content = self._get_resource_update(metadata)
+                    resource_updates += 1
+
+                objects.append(HarvestObject(
+                    guid=dataset.get('id'),
+                    job=harvest_job,
+                    content=harvest_content.encode(
+                        content,
+                        self.COMPRESS_CONTENT_SIZE
+                    ),
+                    extras=[
+                        HarvestObjectExtra(
+                            key='fingerprint',
+                            value=fingerprint
+                        ),
+                        HarvestObjectExtra(
+                            key='metadata_fingerprint',
+                            value=metadata_fingerprint
+                        )
+                    ]
+                ))
+                log.debug('adding ' + dataset.get('id') + ' to the queue')
+                if len(objects) >= self.GATHER_BATCH_SIZE:
+                    ids.extend(self._save_chunk(
+                        publisher,
+                        objects,
+                        len(ids) // self.GATHER_BATCH_SIZE
+                    ))
+                    objects = []
+
+        # The datasets are the same as in the last gather if the metadata
+        # file didn't change
+        if self.DELETE_MISSING and changed_files is None:
+            deleted = self._get_deletions(harvest_job, dataset_ids)
+            deletions = len(deleted)
+            objects.extend(deleted)
+
+        if publisher is not None:
+            # Committed with the last chunk, importing it can end the job
+            harvest_job.gather_finished = datetime.datetime.utcnow()
+        if objects:
+            ids.extend(self._save_chunk(
+                publisher,
+                objects,
+                len(ids) // self.GATHER_BATCH_SIZE
+            ))
+        # All harvest objects of the job are committed at once (unless
+        # they were published in chunks)
+        Session.commit()
+        metrics.incr('db.commit')
+        metrics.incr('gather.queued', len(ids))
+        metrics.incr('gather.unchanged', unchanged)
+        metrics.incr('gather.resource_updates', resource_updates)
+        metrics.incr('gather.deletions', deletions)
+
+        log.info('Queued %s datasets (%s with changed files only, %s to '
+                 'delete), skipped %s unchanged datasets'
+                 % (len(ids), resource_updates, deletions, unchanged))
+        return ids
+
+    def _get_cached_group_id(self, key):
+        '''
+        Return the cached id of a group or organization, None if it is not
+        cached or expired
+        '''
+        cached = self.group_cache.get(key)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        return None
+
+    def _cache_group_id(self, key, group_id, created=False):
+        '''
+        Cache the id of a group or organization. Creating a group
+        invalidates all other cached entries.
+        '''
+        if created:
+            self.group_cache.clear()
+        self.group_cache[key] = (group_id, time.time() + self.GROUP_CACHE_TTL)
+
+    def _find_or_create_group(self, context, group_name):
+        '''
+        Return the id of the group with the given name, the group is
+        created if it does not exist yet
+        '''
+        key = ('group', group_name)
+        group_id = self._get_cached_group_id(key)
+        if group_id is not None:
+            return group_id
+
+        data_dict = {
+            'id': group_name,
+            'name': munge_title_to_name(group_name),
+            'title': group_name
+            }
+        with self.creation_lock:
+            try:
+                with metrics.timer('ckan.group_show'):
+                    group = get_action('group_show')(context, data_dict)
+                log.info('found  group ' + group['id'])
+                self._cache_group_id(key, group['id'])
+            except:
+                with metrics.timer('ckan.group_create'):
+                    group = get_action('group_create')(context, data_dict)
+                log.info('created the group ' + group['id'])
+                self._cache_group_id(key, group['id'], created=True)
+        return group['id']
+
+    def _find_or_create_organization(self, context):
+        '''
+        Return the id of the organization, the organization is created
+        if it does not exist yet
+        '''
+        key = ('organization', self.ORGANIZATION[u'de']['name'])
+        organization_id = self._get_cached_group_id(key)
+        if organization_id is not None:
+            return organization_id
+
+        data_dict = {
+            'permission': 'edit_group',
+            'id': munge_title_to_name(self.ORGANIZATION[u'de']['name']),
+            'name': munge_title_to_name(self.ORGANIZATION[u'de']['name']),
+            'title': self.ORGANIZATION[u'de']['name'],
+            'description': self.ORGANIZATION[u'de']['description'],
+            'extras': [
+                {
+                    'key': 'website',
+                    'value': self.ORGANIZATION[u'de']['website']
+                }
+            ]
+        }
+        with self.creation_lock:
+            try:
+                with metrics.timer('ckan.organization_show'):
+                    organization = get_action('organization_show')(
+                        context,
+                        data_dict
+                    )
+                self._cache_group_id(key, organization['id'])
+            except:
+                with metrics.timer('ckan.organization_create'):
+                    organization = get_action('organization_create')(
+                        context,
+                        data_dict
+                    )
+                self._cache_group_id(key, organization['id'], created=True)
+        return organization['id']
+
+    def _get_job_package_ids(self, harvest_job_id):
+        '''
+        Return the ids of all packages imported by the given harvest job
+        '''
+        query = Session.query(HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.package_id != None)  # noqa
+        return set(package_id for (package_id,) in query.all())
+
+    def _job_is_done(self, harvest_job_id):
+        '''
+        Returns true if the job is done, see job_is_done()
+        '''
+        return job_is_done(harvest_job_id)
+
+    def _index_deferred(self, harvest_object, package_id, job_done):
+        '''
+        Remember a package to be indexed later. The packages are indexed
+        once INDEX_BATCH_SIZE of them are pending, and all packages of the
+        job once its last harvest object has been imported.
+        '''
+        if package_id is not None:
+            self.pending_index.add(package_id)
+        if job_done:
+            # Covers the packages imported by other workers as well
+            self.pending_index.update(
+                self._get_job_package_ids(harvest_object.harvest_job_id)
+            )
+            self.flush_index()
+        elif len(self.pending_index) >= self.INDEX_BATCH_SIZE:
+            self.flush_index()
+
+    def _index_failed_import(self, harvest_object):
+        '''
+        Index all packages of the job if the harvest object whose import
+        failed was its last one. Errors are only logged, so that the import
+        error is the one raised.
+        '''
+        try:
+            Session.rollback()
+            if (harvest_object.state == 'IMPORT'
+                    and self._job_is_done(harvest_object.harvest_job_id)):
+                self._index_deferred(harvest_object, None, True)
+        except Exception:
+            log.exception('Could not index the packages of job %s'
+                          % harvest_object.harvest_job_id)
+
+    def _index_previous_job(self, harvest_job):
+        '''
+        Index the packages of the previous job of the source. Its packages
+        are not indexed if its last harvest objects failed, e.g. were marked
+        as errors after too many retries without being imported.
+        '''
+        previous_job_id = self._get_previous_job_id(harvest_job)
+        if previous_job_id is None:
+            return
+        self.pending_index.update(self._get_job_package_ids(previous_job_id))
+        self.flush_index()
+
+    def flush_index(self):
+        '''
+        Index all pending packages with a single search index commit
+        '''
+        if not self.pending_index:
+            return
+        from ckan.lib import search
+        package_ids = sorted(self.pending_index)
+        self.pending_index.clear()
+        with metrics.timer('search.index'):
+            for package_id in package_ids:
+                search.rebuild(package_id, defer_commit=True)
+            search.commit()
+        log.info('Indexed %s packages' % len(package_ids))
+
+    def _import_package(self, context, harvest_object, package_dict):
+        '''
+        Create or update the package of a harvest object with the full
+        metadata of its dataset and return the package id
+        '''
+        package_dict['id'] = harvest_object.guid
+        package_dict['name'] = self._gen_new_name(
+            package_dict['title'],
+            harvest_object,
+            package_dict['id']
+        )
+
+        user = model.User.get(self.HARVEST_USER)
+
+        # Find or create group the dataset should get assigned to
+        for group_name in package_dict['groups']:
+            if not group_name:
+                raise GroupNotFoundError(
+                    'Group is not defined for dataset %s'
+                    % package_dict['title']
+                )
+            self._find_or_create_group(context, group_name)
+
+        # Find or create the organization
+        # the dataset should get assigned to
+        package_dict['owner_org'] = self._find_or_create_organization(
+            context
+        )
+
+        # Save additional metadata in extras
+        extras = []
+        if 'license_url' in package_dict:
+            extras.append(('license_url', package_dict['license_url']))
+        package_dict['extras'] = extras
+        log.debug('Extras %s' % extras)
+
+        package = model.Package.get(package_dict['id'])
+        model.PackageRole(
+            package=package,
+            user=user,
+            role=model.Role.ADMIN
+        )
+
+        with metrics.timer('ckan.package_create_or_update'):
+            with automatic_indexing_disabled(self.DEFER_INDEXING):
+                self._create_or_update_package(
+                    package_dict,
+                    harvest_object
+                )
+        self.package_names[package_dict['name']] = package_dict['id']
+
+        # Add the translations to the term_translations table, the
+        # organization translations are only written once per job
+        self._write_term_translations(
+            context,
+            harvest_object,
+            package_dict['translations'] +
+            self._generate_organization_translations()
+        )
+        return package_dict['id']
+
+    def _update_resources(self, context, harvest_object, resources):
+        '''
+        Update the url and file fields of the given resources, whose files
+        changed, without touching the rest of the package, and return the
+        package id
+        '''
+        with metrics.timer('ckan.package_show'):
+            package = get_action('package_show')(
+                context,
+                {'id': harvest_object.guid}
+            )
+
+        changed = dict(
+            (resource['name'], resource) for resource in resources
+        )
+        for resource in package['resources']:
+            if resource.get('name') in changed:
+                update_resource = changed[resource['name']]
+                resource['url'] = update_resource['url']
+                for key in FILE_FIELDS:
+                    if key in update_resource:
+                        resource[key] = update_resource[key]
+
+        with metrics.timer('ckan.package_update'):
+            with automatic_indexing_disabled(self.DEFER_INDEXING):
+                get_action('package_update')(context, package)
+        metrics.incr('import.resources_updated', len(changed))
+
+        # The harvest object replaces the previous one of the dataset, so
+        # that the next gather compares against its fingerprints
+        self._replace_current_object(harvest_object)
+        harvest_object.package_id = package['id']
+        harvest_object.current = True
+
+        log.debug('Updated %s resources of %s'
+                  % (len(changed), harvest_object.guid))
+        return package['id']
+
+    def _delete_package(self, context, harvest_object):
+        '''
+        Delete the package of a dataset that was removed from the metadata
+        file. Returns None, the search index is updated right away.
+        '''
+        try:
+            with metrics.timer('ckan.package_delete'):
+                get_action('package_delete')(
+                    context,
+                    {'id': harvest_object.package_id or harvest_object.guid}
+                )
+            metrics.incr('import.deleted')
+            log.info('Deleted the package of %s' % harvest_object.guid)
+        except NotFound:
+            log.info('The package of %s was already deleted'
+                     % harvest_object.guid)
+
+        # Neither this nor any other harvest object of the dataset is
+        # current any more, so it isn't deleted again by the next gather
+        self._replace_current_object(harvest_object)
+        harvest_object.current = False
+        return None
+
+    def _replace_current_object(self, harvest_object):
+        '''
+        Mark the other harvest objects of the dataset as not current
+        '''
+        Session.query(HarvestObject) \
+            .filter(HarvestObject.guid == harvest_object.guid) \
+            .filter(HarvestObject.harvest_source_id ==
+                    harvest_object.harvest_source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.id != harvest_object.id) \
+            .update({'current': False}, synchronize_session=False)  # noqa
+
+    def _gather(self, harvest_job):
+        '''
+        Fetch the metadata file (if it changed) and create the harvest
+        objects of the job
+        '''
+        ids = []
+
+        # Start every gather with a fresh listing of the bucket
+        self.file_index = None
+        self.resource_state = None
+        self.from_manifest = self.USE_MANIFEST and self._load_manifest()
+        changed_files = None
+
+        # The state of the last gather says nothing about datasets whose
+        # import failed, they are gathered again
+        last_job_failed = self._last_job_failed(harvest_job)
+        if last_job_failed:
+            log.info('The last job of the source did not complete, '
+                     'gathering all datasets')
+            if self.DEFER_INDEXING:
+                self._index_previous_job(harvest_job)
+        metadata_stream = self._fetch_metadata(
+            conditional=not last_job_failed
+        )
+        if self.S3_LISTING and not self.from_manifest and (
+                metadata_stream is not None or self.INCREMENTAL):
+            # Runs while the metadata file is parsed with some backends
+            self._get_storage().start_listing()
+        if self.INCREMENTAL and not last_job_failed:
+            # Without it all files count as changed
+            self.resource_state = self._get_resource_state()
+        if metadata_stream is None:
+            if not self.INCREMENTAL:
+                log.info('No change in %s, nothing to gather'
+                         % self.METADATA_FILE_NAME)
+                return ids
+            # The datasets didn't change, but their files may have
+            changed_files = self._get_changed_files()
+            if not changed_files and changed_files is not None:
+                log.info('No change in %s and its files, nothing to gather'
+                         % self.METADATA_FILE_NAME)
+                return ids
+            metadata_stream = self._open_cached_metadata()
+
+        try:
+            ids = self._gather_datasets(
+                harvest_job,
+                metadata_stream,
+                changed_files
+            )
+        finally:
+            metadata_stream.close()
+            self._get_storage().finish()
+
+        self._store_metadata_state()
+        if self.INCREMENTAL:
+            self._store_resource_state()
+        return ids
+
     def info(self):
         return {
             'name': 'zhstat',
@@ -302,51 +1517,18 @@ class ZhstatHarvester(HarvesterBase):
     def gather_stage(self, harvest_job):
         log.debug('In ZhstatHarvester gather_stage')
 
-        ids = []
-        parser = etree.XMLParser(encoding='utf-8')
-
-        for dataset in etree.fromstring(self._fetch_metadata(), parser=parser):
-
-            # Get the german data if one is available,
-            # otherwise get the first one
-            base_datas = dataset.xpath("data[@xml:lang='de']")
-            if len(base_datas) != 0:
-                base_data = base_datas[0]
-            else:
-                base_data = dataset.find('data')
-
-            metadata = self._generate_metadata(base_data, dataset)
-
-            if metadata:
-                obj = HarvestObject(
-                    guid=dataset.get('id'),
-                    job=harvest_job,
-                    content=json.dumps(metadata)
-                )
-                obj.save()
-                log.debug('adding ' + dataset.get('id') + ' to the queue')
-                ids.append(obj.id)
-            else:
-                log.debug(
-                    'Skipping %s since no resources or groups are available'
-                    % dataset.get('id')
-                )
-
+        with metrics.timer('gather.total'):
+            ids = self._gather(harvest_job)
+        metrics.flush('gather', harvest_job.id)
         return ids
 
     def fetch_stage(self, harvest_object):
         log.debug('In ZhstatHarvester fetch_stage')
 
-        dataset_id = json.loads(harvest_object.content)['datasetID']
-        log.debug(harvest_object.content)
-
-        try:
-            harvest_object.save()
-            log.debug('successfully processed ' + dataset_id)
-            return True
-        except Exception, detail:
-            log.exception(detail)
-            raise
+        # The content was stored during the gather stage, so there is
+        # nothing to fetch (or commit, or decode) here
+        log.debug('successfully processed ' + harvest_object.guid)
+        return True
 
     def import_stage(self, harvest_object):
         log.debug('In ZhstatHarvester import_stage')
@@ -355,95 +1537,196 @@ class ZhstatHarvester(HarvesterBase):
             log.error('No harvest object received')
             return False
 
-        try:
-            package_dict = json.loads(harvest_object.content)
+        start = time.time()
+        flush_due = start - self.metrics_flushed >= self.METRICS_FLUSH_INTERVAL
+        if harvest_object.harvest_job_id != self.metrics_job_id or flush_due:
+            # Metrics of the previous job, or so far of the current one
+            metrics.flush('import', self.metrics_job_id)
+            self.metrics_job_id = harvest_object.harvest_job_id
+            self.metrics_flushed = start
 
-            package_dict['id'] = harvest_object.guid
-            package_dict['name'] = self._gen_new_name(
-                package_dict['title'],
-                package_dict['id']
-            )
-
-            user = model.User.get(self.HARVEST_USER)
+        try:
+            with metrics.timer('import.decode'):
+                package_dict = harvest_content.decode(harvest_object.content)
             context = {
                 'model': model,
                 'session': Session,
                 'user': self.HARVEST_USER
                 }
 
-            # Find or create group the dataset should get assigned to
-            for group_name in package_dict['groups']:
-                if not group_name:
-                    raise GroupNotFoundError(
-                        'Group is not defined for dataset %s'
-                        % package_dict['title']
-                    )
-                data_dict = {
-                    'id': group_name,
-                    'name': munge_title_to_name(group_name),
-                    'title': group_name
-                    }
-                try:
-                    group = get_action('group_show')(context, data_dict)
-                    log.info('found  group ' + group['id'])
-                except:
-                    group = get_action('group_create')(context, data_dict)
-                    log.info('created the group ' + group['id'])
-
-            # Find or create the organization
-            # the dataset should get assigned to
-            data_dict = {
-                'permission': 'edit_group',
-                'id': munge_title_to_name(self.ORGANIZATION[u'de']['name']),
-                'name': munge_title_to_name(self.ORGANIZATION[u'de']['name']),
-                'title': self.ORGANIZATION[u'de']['name'],
-                'description': self.ORGANIZATION[u'de']['description'],
-                'extras': [
-                    {
-                        'key': 'website',
-                        'value': self.ORGANIZATION[u'de']['website']
-                    }
-                ]
-            }
-            try:
-                package_dict['owner_org'] = get_action('organization_show')(
+            update = package_dict.pop('update', None)
+            changed_resources = package_dict.pop('changed_resources', None)
+            if update == 'delete':
+                package_id = self._delete_package(context, harvest_object)
+            elif update == 'resources' and harvest_object.state == 'IMPORT':
+                # Re-imports with the 'harvester import' command (of
+                # COMPLETE objects) update the whole package
+                package_id = self._update_resources(
                     context,
-                    data_dict
-                )['id']
-            except:
-                organization = get_action('organization_create')(
+                    harvest_object,
+                    [resource for resource in package_dict['resources']
+                     if resource['name'] in changed_resources]
+                )
+            else:
+                package_id = self._import_package(
                     context,
-                    data_dict
+                    harvest_object,
+                    package_dict
                 )
-                package_dict['owner_org'] = organization['id']
-
-            # Save additional metadata in extras
-            extras = []
-            if 'license_url' in package_dict:
-                extras.append(('license_url', package_dict['license_url']))
-            package_dict['extras'] = extras
-            log.debug('Extras %s' % extras)
-
-            package = model.Package.get(package_dict['id'])
-            model.PackageRole(
-                package=package,
-                user=user,
-                role=model.Role.ADMIN
-            )
-
-            self._create_or_update_package(package_dict, harvest_object)
-
-            # Add the translations to the term_translations table
-            for translation in package_dict['translations']:
-                action.update.term_translation_update(context, translation)
             Session.commit()
+            metrics.incr('db.commit')
+            metrics.timing('import.total', time.time() - start)
+
+            if self.DEFER_INDEXING:
+                # Objects imported with the 'harvester import' command are
+                # not in the IMPORT state and don't end a job
+                job_done = (
+                    harvest_object.state == 'IMPORT'
+                    and self._job_is_done(harvest_object.harvest_job_id)
+                )
+                self._index_deferred(harvest_object, package_id, job_done)
+                if job_done:
+                    metrics.flush('import', harvest_object.harvest_job_id)
 
         except Exception, detail:
             log.exception(detail)
+            if self.DEFER_INDEXING:
+                # The failed object may be the last one of the job
+                self._index_failed_import(harvest_object)
             raise
 
         return True
 
 
+def job_is_done(harvest_job_id):
+    '''
+    Returns true if the gather of the job finished and no harvest object
+    of the job still waits to be fetched. Objects that other workers are
+    importing at the same time don't count, every one of them checks
+    again once it is imported, so the workers importing the last objects
+    all see the job as done.
+    '''
+    # A chunked gather publishes objects before it finished
+    gather_finished = Session.query(HarvestJob.gather_finished) \
+        .filter(HarvestJob.id == harvest_job_id) \
+        .scalar()
+    if gather_finished is None:
+        return False
+    remaining = Session.query(HarvestObject.id) \
+        .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+        .filter(HarvestObject.state.in_(['WAITING', 'FETCH'])) \
+        .count()
+    return remaining == 0
+
+
+@contextmanager
+def automatic_indexing_disabled(disabled=True):
+    '''
+    Suppress the synchronous search index update of CKAN for the packages
+    created or updated inside the block (unless disabled is false)
+    '''
+    if not disabled:
+        yield
+        return
+    previous = config.get('ckan.search.automatic_indexing')
+    config['ckan.search.automatic_indexing'] = 'false'
+    try:
+        yield
+    finally:
+        if previous is None:
+            del config['ckan.search.automatic_indexing']
+        else:
+            config['ckan.search.automatic_indexing'] = previous
+
+
+class MetadataStream(object):
+    '''
+    File-like wrapper around an S3 key opened for reading, that writes
+    everything read through it to a local cache file. The cache file is
+    only replaced once the whole key has been read.
+    '''
+
+    def __init__(self, key, cache_path):
+        self.key = key
+        self.cache_path = cache_path
+        self.cache_file = open(cache_path + '.part', 'wb')
+        self.complete = False
+
+    def read(self, size=-1):
+        # boto reads the whole key for a size of 0
+        data = self.key.read(max(size, 0))
+        if data:
+            self.cache_file.write(data)
+        elif size != 0:
+            self.complete = True
+        return data
+
+    def close(self):
+        self.key.close()
+        self.cache_file.close()
+        if self.complete:
+            os.rename(self.cache_path + '.part', self.cache_path)
+        else:
+            os.remove(self.cache_path + '.part')
+
+
+class DataRecord(object):
+    '''
+    The values of one <data> element (one language) of a dataset,
+    extracted in a single pass over its children
+    '''
+
+    __slots__ = (
+        'lang', 'url', 'title', 'author', 'author_email', 'description',
+        'maintainer', 'maintainer_email', 'license', 'license_url',
+        'version', 'tags', 'groups', 'resources',
+    )
+
+    TEXT_FIELDS = frozenset([
+        'url', 'title', 'author', 'author_email', 'description',
+        'maintainer', 'maintainer_email', 'version',
+    ])
+    TRANSLATED_FIELDS = ('title', 'author', 'maintainer', 'description')
+
+    def __init__(self, data):
+        self.lang = data.get(XML_LANG)
+        for field in self.TEXT_FIELDS:
+            setattr(self, field, None)
+        self.license = None
+        self.license_url = None
+        self.tags = []
+        self.groups = []
+        self.resources = []
+
+        for child in data:
+            tag = child.tag
+            if tag in self.TEXT_FIELDS:
+                setattr(self, tag, child.text)
+            elif tag == 'license':
+                self.license = child.text
+                self.license_url = child.get('url')
+            elif tag == 'tags':
+                self.tags = [t.text for t in child if t.tag == 'tag']
+            elif tag == 'groups':
+                self.groups = [g.text for g in child if g.tag == 'group']
+            elif tag == 'resources':
+                self.resources = [self._resource(r) for r in child]
+
+    def _resource(self, resource):
+        '''
+        Return (name, type, description) of a <resource> element
+        '''
+        name = file_format = None
+        description = ''
+        for child in resource:
+            if child.tag == 'name':
+                name = child.text
+            elif child.tag == 'type':
+                file_format = child.text
+            elif child.tag == 'description':
+                description = child.text
+        return (name, file_format, description)
+
+
 class GroupNotFoundError(Exception):
     pass
@@ -0,0 +1,129 @@
+'''
+Persistent manifest of the files below the data path
+
+The manifest is a SQLite database with the size, etag, MD5 checksum,
+content type and last modification date of every file. It is updated by
+the 'harvester manifest' command, which only looks up the details of the
+files whose etag changed since the last update, and read by the gather
+stage with a single query instead of listing or probing the storage.
+'''
+
+import os
+import time
+import sqlite3
+
+from ckanext.zhstat.storage import StoredFile
+
+import logging
+log = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    size INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    md5 TEXT,
+    content_type TEXT
+);
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class Manifest(object):
+    '''
+    The manifest database at path
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def load(self):
+        '''
+        Return all files of the manifest as StoredFile tuples, keyed by name
+        '''
+        connection = self._connect()
+        try:
+            return dict(
+                (row[0], StoredFile(*row[1:]))
+                for row in connection.execute(
+                    'SELECT name, size, etag, last_modified, md5, '
+                    'content_type FROM files'
+                )
+            )
+        finally:
+            connection.close()
+
+    def updated(self):
+        '''
+        Return the time of the last update (or None)
+        '''
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT value FROM info WHERE key = 'updated'"
+            ).fetchone()
+            return float(row[0]) if row else None
+        finally:
+            connection.close()
+
+    def update(self, storage):
+        '''
+        Bring the manifest up to date with the files of a storage backend,
+        returns the number of added or changed and of removed files
+        '''
+        files = storage.list()
+        known = self.load()
+        changed = [
+            name for name, stored_file in files.items()
+            if name not in known or known[name].etag != stored_file.etag
+        ]
+        removed = [name for name in known if name not in files]
+        details = storage.describe_many(changed)
+
+        rows = []
+        for name in changed:
+            stored_file = files[name]
+            md5, content_type = details.get(name, (None, None))
+            rows.append((
+                name,
+                stored_file.size,
+                stored_file.etag,
+                stored_file.last_modified,
+                md5,
+                content_type
+            ))
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                    rows
+                )
+                connection.executemany(
+                    'DELETE FROM files WHERE name = ?',
+                    [(name,) for name in removed]
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO info VALUES ('updated', ?)",
+                    (repr(time.time()),)
+                )
+        finally:
+            connection.close()
+        log.info('Updated the manifest %s: %s files added or changed, %s '
+                 'removed, %s unchanged'
+                 % (self.path, len(changed), len(removed),
+                    len(files) - len(changed)))
+        return len(changed), len(removed)
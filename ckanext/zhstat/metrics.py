@@ -0,0 +1,216 @@
+'''
+Counters and timers for the hot paths of the harvester
+
+The harvester records S3 requests, XML parsing, metadata generation, CKAN
+action calls and database commits in the process-wide `metrics` object.
+At the end of a job stage the summary is logged and sent to the sinks
+configured with ckanext.zhstat.metrics, a space separated list of:
+
+    statsd://host:port[/prefix]    gauges sent to a StatsD daemon over UDP
+    prometheus:///path/file.prom   Prometheus text format (textfile collector)
+    file:///path/metrics.log       one JSON line per summary
+'''
+
+import os
+import json
+import time
+import socket
+import threading
+import urlparse
+from contextlib import contextmanager
+
+from pylons import config
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    '''
+    Counters and timers collected since the last flush
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.sinks = None
+        # S3 requests are also made from the probing threads
+        self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self.lock:
+            count, total, maximum = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (
+                count + 1,
+                total + seconds,
+                max(maximum, seconds)
+            )
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start)
+
+    def summary(self):
+        '''
+        Return a readable summary of the collected metrics
+        '''
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append('%-40s %10s' % (name, value))
+        for name, (count, total, maximum) in sorted(self.timers.items()):
+            lines.append('%-40s %10s calls %10.3fs total %8.1fms avg '
+                         '%8.1fms max' % (name, count, total,
+                                          total / count * 1000,
+                                          maximum * 1000))
+        return '\n'.join(lines)
+
+    def flush(self, stage, job_id=None):
+        '''
+        Log the collected metrics, send them to the configured sinks and
+        start over
+        '''
+        if not self.counters and not self.timers:
+            return
+        log.info('Metrics of the %s stage of job %s:\n%s'
+                 % (stage, job_id, self.summary()))
+        if self.sinks is None:
+            self.sinks = get_sinks(config.get('ckanext.zhstat.metrics', ''))
+        for sink in self.sinks:
+            try:
+                sink.send(stage, job_id, self.counters, self.timers)
+            except Exception, detail:
+                log.warning('Could not send metrics to %s: %s'
+                            % (sink, detail))
+        self.counters = {}
+        self.timers = {}
+
+
+def get_sinks(setting):
+    '''
+    Return the metric sinks for the ckanext.zhstat.metrics setting
+    '''
+    sinks = []
+    for url in setting.split():
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme == 'statsd':
+            host, _, port = parsed.netloc.partition(':')
+            sinks.append(StatsdSink(
+                host or 'localhost',
+                int(port or 8125),
+                parsed.path.strip('/') or 'zhstat'
+            ))
+        elif parsed.scheme == 'prometheus':
+            sinks.append(PrometheusSink(parsed.path))
+        elif parsed.scheme == 'file':
+            sinks.append(FileSink(parsed.path))
+        else:
+            log.warning('Unknown metrics sink %s' % url)
+    return sinks
+
+
+def prometheus_name(name):
+    return name.replace('.', '_').replace('-', '_')
+
+
+class StatsdSink(object):
+    '''
+    Sends the metrics as StatsD gauges over UDP
+    '''
+
+    def __init__(self, host, port, prefix):
+        self.address = (host, port)
+        self.prefix = prefix
+
+    def __str__(self):
+        return 'statsd://%s:%s/%s' % (self.address + (self.prefix,))
+
+    def send(self, stage, job_id, counters, timers):
+        lines = []
+        for name, value in counters.items():
+            lines.append('%s.%s.%s:%s|g' % (self.prefix, stage, name, value))
+        for name, (count, total, maximum) in timers.items():
+            base = '%s.%s.%s' % (self.prefix, stage, name)
+            lines.append('%s.count:%s|g' % (base, count))
+            lines.append('%s.total_ms:%d|g' % (base, total * 1000))
+            lines.append('%s.max_ms:%d|g' % (base, maximum * 1000))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Stay below the usual MTU with every packet
+            packet = []
+            for line in lines:
+                if packet and len('\n'.join(packet + [line])) > 1400:
+                    sock.sendto('\n'.join(packet), self.address)
+                    packet = []
+                packet.append(line)
+            if packet:
+                sock.sendto('\n'.join(packet), self.address)
+        finally:
+            sock.close()
+
+
+class PrometheusSink(object):
+    '''
+    Writes the metrics of the last job of each stage in the Prometheus
+    text format, e.g. for the textfile collector of the node exporter
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+
+    def __str__(self):
+        return 'prometheus://%s' % self.path
+
+    def send(self, stage, job_id, counters, timers):
+        lines = []
+        for name, value in sorted(counters.items()):
+            lines.append('zhstat_%s_%s_total %s'
+                         % (stage, prometheus_name(name), value))
+        for name, (count, total, maximum) in sorted(timers.items()):
+            base = 'zhstat_%s_%s_seconds' % (stage, prometheus_name(name))
+            lines.append('%s_count %s' % (base, count))
+            lines.append('%s_sum %f' % (base, total))
+            lines.append('%s_max %f' % (base, maximum))
+        self.stages[stage] = lines
+
+        with open(self.path + '.part', 'w') as prom_file:
+            for stage_lines in self.stages.values():
+                prom_file.write('\n'.join(stage_lines) + '\n')
+        os.rename(self.path + '.part', self.path)
+
+
+class FileSink(object):
+    '''
+    Appends every summary as a JSON line to a local file
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'file://%s' % self.path
+
+    def send(self, stage, job_id, counters, timers):
+        record = {
+            'time': time.time(),
+            'stage': stage,
+            'job_id': job_id,
+            'counters': counters,
+            'timers': dict(
+                (name, {'count': count, 'total': total, 'max': maximum})
+                for name, (count, total, maximum) in timers.items()
+            ),
+        }
+        with open(self.path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(record) + '\n')
+
+
+metrics = Metrics()
@@ -0,0 +1,522 @@
+'''
+Storage backends the harvester reads the metadata file and the resource
+files from
+
+A backend is selected with ckanext.zhstat.storage:
+
+    s3              the S3 bucket, one request at a time (default)
+    s3-concurrent   the S3 bucket, listing the files and downloading the
+                    metadata file in background threads while the gather
+                    processes the datasets
+    local           a local directory, e.g. a mirror of the bucket kept up
+                    to date by a sync job (ckanext.zhstat.local_path)
+
+All backends return the properties of the files as StoredFile tuples,
+keyed by the file name relative to the data path. The MD5 checksum and the
+content type are only known for the files of a manifest.
+'''
+
+import os
+import sys
+import codecs
+import mmap
+import Queue
+import hashlib
+import mimetypes
+import urllib
+import threading
+from collections import namedtuple
+from email.utils import formatdate
+
+from ckanext.zhstat.metrics import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+StoredFile = namedtuple(
+    'StoredFile',
+    ['size', 'etag', 'last_modified', 'md5', 'content_type']
+)
+StoredFile.__new__.__defaults__ = (None, None)
+
+# Encoding of the file names in the local file system. Daemons started
+# with the C locale report ASCII, the names are UTF-8 nevertheless.
+FS_ENCODING = sys.getfilesystemencoding() or 'utf-8'
+if codecs.lookup(FS_ENCODING).name == 'ascii':
+    FS_ENCODING = 'utf-8'
+
+
+def to_unicode(name):
+    '''
+    Return a file name as unicode, byte strings are UTF-8 like in the
+    metadata file
+    '''
+    if isinstance(name, str):
+        return name.decode('utf-8')
+    return name
+
+
+def get_storage(name, **kwargs):
+    '''
+    Return the storage backend with the given name
+    '''
+    backends = {
+        's3': S3Storage,
+        's3-concurrent': ConcurrentS3Storage,
+        'local': LocalStorage,
+    }
+    if name not in backends:
+        raise ValueError('Unknown storage backend %s' % name)
+    return backends[name](**kwargs)
+
+
+class S3Storage(object):
+    '''
+    Reads the files below a prefix of an S3 bucket
+    '''
+
+    # Whether the files can be read again at any time without a request
+    is_local = False
+
+    def __init__(self, bucket_name, access_key, secret_key, prefix,
+                 probe_workers=8, **kwargs):
+        self.bucket_name = bucket_name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.prefix = prefix
+        self.probe_workers = probe_workers
+        self.bucket = None
+        self.probe_pool = None
+        self.probe_local = threading.local()
+
+    def _get_bucket(self):
+        '''
+        Create an S3 connection to the department bucket
+        '''
+        if self.bucket is None:
+            from boto.s3.connection import S3Connection
+            conn = S3Connection(self.access_key, self.secret_key)
+            self.bucket = conn.get_bucket(self.bucket_name)
+        return self.bucket
+
+    def _get_thread_bucket(self):
+        '''
+        Return an S3 bucket with a connection for the current thread
+        '''
+        if getattr(self.probe_local, 'bucket', None) is None:
+            from boto.s3.connection import S3Connection
+            conn = S3Connection(self.access_key, self.secret_key)
+            self.probe_local.bucket = conn.get_bucket(
+                self.bucket_name,
+                validate=False
+            )
+        return self.probe_local.bucket
+
+    def _stored_file(self, key):
+        return StoredFile(
+            size=key.size,
+            etag=key.etag.strip('"'),
+            last_modified=key.last_modified
+        )
+
+    def start_listing(self):
+        '''
+        Called at the start of a gather that will list the files
+        '''
+        pass
+
+    def open_metadata(self, file_name, etag=None, last_modified=None):
+        '''
+        Open a file for reading, unless its ETag is etag or it was not
+        modified since last_modified. Returns None in that case, otherwise
+        a file-like object with the etag and last_modified of the file,
+        whose read() returns the whole rest of the file for a size of 0.
+        '''
+        from boto.exception import S3ResponseError
+        headers = {}
+        if etag is not None:
+            headers['If-None-Match'] = '"%s"' % etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        key = self._get_bucket().new_key(self.prefix + file_name)
+        try:
+            with metrics.timer('s3.get_metadata'):
+                key.open_read(headers=headers)
+        except S3ResponseError, detail:
+            if detail.status == 304:
+                return None
+            raise
+        return key
+
+    def list(self):
+        '''
+        Return the properties of all files, with as few requests as possible
+        '''
+        files = {}
+        prefix_length = len(self.prefix)
+        # bucket.list() pages through the results (1000 keys per request)
+        with metrics.timer('s3.list'):
+            for key in self._get_bucket().list(prefix=self.prefix):
+                files[key.name[prefix_length:]] = self._stored_file(key)
+        return files
+
+    def stat(self, file_name):
+        '''
+        Look up a single file, returns None if the file does not exist
+        '''
+        with metrics.timer('s3.head'):
+            key = self._get_thread_bucket().get_key(self.prefix + file_name)
+        if key is None:
+            return None
+        return self._stored_file(key)
+
+    def _get_probe_pool(self):
+        '''
+        Return the pool of threads sending the HEAD requests
+        '''
+        if self.probe_pool is None:
+            from multiprocessing.pool import ThreadPool
+            self.probe_pool = ThreadPool(self.probe_workers)
+        return self.probe_pool
+
+    def stat_many_async(self, file_names):
+        '''
+        Start looking up the given files in parallel. The get() method of
+        the returned lookup waits for the properties of the ones that exist.
+        '''
+        return FileLookup(
+            file_names,
+            self._get_probe_pool().map_async(self.stat, file_names)
+        )
+
+    def describe(self, file_name):
+        '''
+        Return the MD5 checksum and the content type of a file (or None if
+        it doesn't exist). The ETag of a multipart upload is no checksum.
+        '''
+        with metrics.timer('s3.head'):
+            key = self._get_thread_bucket().get_key(self.prefix + file_name)
+        if key is None:
+            return None
+        etag = key.etag.strip('"')
+        return (None if '-' in etag else etag, key.content_type)
+
+    def describe_many(self, file_names):
+        '''
+        Describe the given files in parallel, returns a dict of the
+        descriptions of the ones that exist
+        '''
+        results = self._get_probe_pool().map(self.describe, file_names)
+        return dict(
+            (file_name, description)
+            for file_name, description in zip(file_names, results)
+            if description is not None
+        )
+
+    def url(self, file_name):
+        '''
+        Generate a public URL for the given file (no request to S3)
+        '''
+        key = self._get_bucket().new_key(self.prefix + file_name)
+        return key.generate_url(0, query_auth=False, force_http=True)
+
+    def finish(self):
+        '''
+        Release the threads used during a gather
+        '''
+        if self.probe_pool is not None:
+            self.probe_pool.terminate()
+            self.probe_pool = None
+
+
+class LocalStorage(object):
+    '''
+    Reads the files below a prefix of a local directory. The metadata file
+    is memory-mapped instead of copied, the properties of the other files
+    come from os.stat().
+    '''
+
+    is_local = True
+
+    def __init__(self, path, prefix, base_url, **kwargs):
+        self.path = to_unicode(path)
+        self.prefix = to_unicode(prefix)
+        # The resources are still downloaded from the original location
+        self.base_url = base_url
+
+    def _path(self, file_name):
+        '''
+        Return the path of a file, encoded for the file system
+        '''
+        return os.path.join(
+            self.path,
+            self.prefix,
+            *to_unicode(file_name).split('/')
+        ).encode(FS_ENCODING)
+
+    def _stored_file(self, stat):
+        return StoredFile(
+            size=stat.st_size,
+            etag='%x-%x' % (int(stat.st_mtime), stat.st_size),
+            last_modified=formatdate(stat.st_mtime, usegmt=True)
+        )
+
+    def start_listing(self):
+        pass
+
+    def open_metadata(self, file_name, etag=None, last_modified=None):
+        '''
+        Open a file for reading through a memory map, unless its etag is
+        etag. The etag of local files is made up of their modification
+        time and size.
+        '''
+        path = self._path(file_name)
+        stored_file = self._stored_file(os.stat(path))
+        if etag is not None and stored_file.etag == etag:
+            return None
+        return MappedFile(path, stored_file.etag, stored_file.last_modified)
+
+    def list(self):
+        files = {}
+        root = self._path('')
+        with metrics.timer('local.list'):
+            for dir_path, dir_names, file_names in os.walk(root):
+                relative = os.path.relpath(dir_path, root)
+                for file_name in file_names:
+                    stored_file = self._stored_file(
+                        os.stat(os.path.join(dir_path, file_name))
+                    )
+                    if relative != '.':
+                        file_name = '/'.join(
+                            relative.split(os.sep) + [file_name]
+                        )
+                    try:
+                        file_name = file_name.decode(FS_ENCODING)
+                    except UnicodeDecodeError:
+                        log.warning('Skipping %r, the name is not %s'
+                                    % (file_name, FS_ENCODING))
+                        continue
+                    files[file_name] = stored_file
+        return files
+
+    def stat(self, file_name):
+        try:
+            return self._stored_file(os.stat(self._path(file_name)))
+        except (OSError, UnicodeError):
+            return None
+
+    def stat_many_async(self, file_names):
+        # Local lookups are fast enough to be made right away
+        with metrics.timer('local.stat'):
+            return CompletedLookup(dict(
+                (file_name, stored_file)
+                for file_name, stored_file
+                in zip(file_names, map(self.stat, file_names))
+                if stored_file is not None
+            ))
+
+    def describe(self, file_name):
+        try:
+            md5 = hashlib.md5()
+            with open(self._path(file_name), 'rb') as local_file:
+                for block in iter(lambda: local_file.read(1024 * 1024), ''):
+                    md5.update(block)
+        except (IOError, UnicodeError):
+            return None
+        content_type = mimetypes.guess_type(file_name)[0]
+        return (md5.hexdigest(), content_type or 'application/octet-stream')
+
+    def describe_many(self, file_names):
+        with metrics.timer('local.describe'):
+            return dict(
+                (file_name, description)
+                for file_name, description
+                in zip(file_names, map(self.describe, file_names))
+                if description is not None
+            )
+
+    def url(self, file_name):
+        return self.base_url + urllib.quote(
+            (self.prefix + to_unicode(file_name)).encode('utf-8')
+        )
+
+    def finish(self):
+        pass
+
+
+class MappedFile(object):
+    '''
+    File-like object that reads a local file through a read-only memory map
+    '''
+
+    def __init__(self, path, etag, last_modified):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.file = open(path, 'rb')
+        self.map = None
+        if os.fstat(self.file.fileno()).st_size:
+            self.map = mmap.mmap(
+                self.file.fileno(),
+                0,
+                access=mmap.ACCESS_READ
+            )
+
+    def read(self, size=0):
+        # Like a boto key, the whole rest is returned for a size of 0
+        if self.map is None:
+            return ''
+        if size <= 0:
+            size = self.map.size() - self.map.tell()
+        return self.map.read(size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class CompletedLookup(object):
+    '''
+    Lookup of several files whose results are already known
+    '''
+
+    def __init__(self, files):
+        self.files = files
+
+    def get(self):
+        return self.files
+
+
+class FileLookup(object):
+    '''
+    Pending lookup of several files
+    '''
+
+    def __init__(self, file_names, result):
+        self.file_names = file_names
+        self.result = result
+
+    def get(self):
+        # map_async() returns the results in the order of file_names
+        return dict(
+            (file_name, stored_file)
+            for file_name, stored_file
+            in zip(self.file_names, self.result.get())
+            if stored_file is not None
+        )
+
+
+class ConcurrentS3Storage(S3Storage):
+    '''
+    Lists the bucket in a background thread from the start of a gather and
+    reads ahead of the parser while downloading the metadata file, so that
+    the gather doesn't wait for one request after the other
+    '''
+
+    listing = None
+
+    def start_listing(self):
+        self.listing = BackgroundCall(super(ConcurrentS3Storage, self).list)
+
+    def open_metadata(self, file_name, etag=None, last_modified=None):
+        key = super(ConcurrentS3Storage, self).open_metadata(
+            file_name,
+            etag,
+            last_modified
+        )
+        if key is None:
+            return None
+        return ReadAheadFile(key)
+
+    def list(self):
+        if self.listing is None:
+            return super(ConcurrentS3Storage, self).list()
+        listing, self.listing = self.listing, None
+        return listing.result()
+
+
+class BackgroundCall(object):
+    '''
+    Runs a function in a thread of its own, result() waits for its return
+    value (or raises its exception)
+    '''
+
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(func,) + args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, *args):
+        try:
+            self.value = func(*args)
+        except Exception, detail:
+            self.error = detail
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class ReadAheadFile(object):
+    '''
+    File-like wrapper around an S3 key opened for reading, that downloads
+    the key in a background thread up to MAX_BLOCKS blocks ahead of the
+    reader
+    '''
+
+    BLOCK_SIZE = 64 * 1024
+    MAX_BLOCKS = 256
+
+    def __init__(self, key):
+        self.key = key
+        self.etag = key.etag
+        self.last_modified = key.last_modified
+        self.blocks = Queue.Queue(self.MAX_BLOCKS)
+        self.buffer = ''
+        self.done = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._download)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _download(self):
+        try:
+            while not self.closed:
+                data = self.key.read(self.BLOCK_SIZE)
+                self.blocks.put(data)
+                if not data:
+                    break
+        except Exception, detail:
+            self.error = detail
+            self.blocks.put('')
+
+    def read(self, size=0):
+        # Like a boto key, the whole rest is returned for a size of 0
+        while not self.done and (size <= 0 or len(self.buffer) < size):
+            block = self.blocks.get()
+            if not block:
+                self.done = True
+                if self.error is not None:
+                    raise self.error
+            self.buffer += block
+        if size <= 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+        # Unblock the download thread if it waits for the reader
+        while self.thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self.key.close()
@@ -0,0 +1,59 @@
+# coding: utf-8
+import json
+import unittest
+
+from ckanext.zhstat import content
+
+METADATA = {
+    'title': u'Bevölkerung',
+    'tags': [u'zürich', u'bevölkerung'],
+    'resources': [{'name': u'bevölkerung.csv', 'size': 1024}],
+    'translations': [
+        {'lang_code': u'fr', 'term': u'Bevölkerung',
+         'term_translation': u'Population'},
+        {'lang_code': u'it', 'term': u'Bevölkerung',
+         'term_translation': u'Popolazione'},
+        {'lang_code': u'fr', 'term': None,
+         'term_translation': u'Description'},
+        {'lang_code': u'it', 'term': u'Zürich',
+         'term_translation': None},
+    ],
+}
+
+
+class TestContent(unittest.TestCase):
+
+    def test_uncompressed_round_trip(self):
+        encoded = content.encode(METADATA)
+        self.assertTrue(isinstance(encoded, unicode))
+        self.assertFalse(encoded.startswith(content.COMPRESSED_PREFIX))
+        # Non-ASCII characters are not escaped
+        self.assertTrue(u'Bevölkerung' in encoded)
+        self.assertEqual(content.decode(encoded), METADATA)
+
+    def test_compressed_round_trip(self):
+        encoded = content.encode(METADATA, compress_size=10)
+        self.assertTrue(isinstance(encoded, unicode))
+        self.assertTrue(encoded.startswith(content.COMPRESSED_PREFIX))
+        self.assertEqual(content.decode(encoded), METADATA)
+
+    def test_below_compress_size(self):
+        encoded = content.encode(METADATA, compress_size=100000)
+        self.assertFalse(encoded.startswith(content.COMPRESSED_PREFIX))
+        self.assertEqual(content.decode(encoded), METADATA)
+
+    def test_terms_are_stored_once(self):
+        encoded = json.loads(content.encode(METADATA))
+        self.assertEqual(
+            encoded['translations']['terms'],
+            [u'Bevölkerung', None, u'Zürich']
+        )
+
+    def test_without_translations(self):
+        metadata = {'title': u'Bevölkerung'}
+        self.assertEqual(content.decode(content.encode(metadata)), metadata)
+
+    def test_legacy_content(self):
+        legacy = json.dumps(METADATA)
+        self.assertEqual(content.decode(legacy), METADATA)
+        self.assertEqual(content.decode(unicode(legacy)), METADATA)
@@ -0,0 +1,76 @@
+import unittest
+
+from ckan.model import PACKAGE_NAME_MAX_LENGTH
+
+from ckanext.zhstat.harvesters.zhstatharvester import ZhstatHarvester
+
+
+class HarvestObject(object):
+    harvest_job_id = 'job'
+
+
+class NamesHarvester(ZhstatHarvester):
+    '''
+    Looks up the names in a dict instead of the database
+    '''
+    def __init__(self, package_names):
+        super(NamesHarvester, self).__init__()
+        self.package_names = package_names
+
+    def _get_package_names(self, harvest_object):
+        return self.package_names
+
+    def _name_is_free(self, package_names, name, current_id):
+        return package_names.get(name) in (None, current_id)
+
+
+class TestGenNewName(unittest.TestCase):
+
+    def _gen_new_name(self, title, current_id, package_names):
+        harvester = NamesHarvester(package_names)
+        return harvester._gen_new_name(title, HarvestObject(), current_id)
+
+    def test_free_name(self):
+        name = self._gen_new_name(u'Bevoelkerung', u'ZH.1', {})
+        self.assertEqual(name, u'bevoelkerung')
+
+    def test_own_name(self):
+        name = self._gen_new_name(
+            u'Bevoelkerung', u'ZH.1', {u'bevoelkerung': u'ZH.1'}
+        )
+        self.assertEqual(name, u'bevoelkerung')
+
+    def test_name_collision_is_stable(self):
+        package_names = {u'bevoelkerung': u'ZH.1'}
+        name = self._gen_new_name(u'Bevoelkerung', u'ZH.2', package_names)
+        self.assertTrue(name.startswith(u'bevoelkerung-'))
+        self.assertEqual(len(name), len(u'bevoelkerung-') + 5)
+        self.assertEqual(
+            name,
+            self._gen_new_name(u'Bevoelkerung', u'ZH.2', package_names)
+        )
+
+    def test_counter_after_hash_collision(self):
+        hashed = self._gen_new_name(
+            u'Bevoelkerung', u'ZH.2', {u'bevoelkerung': u'ZH.1'}
+        )
+        name = self._gen_new_name(
+            u'Bevoelkerung',
+            u'ZH.2',
+            {u'bevoelkerung': u'ZH.1', hashed: u'ZH.3'}
+        )
+        self.assertEqual(name, u'bevoelkerung-2')
+
+    def test_long_title_collision(self):
+        title = u' '.join([u'Bevoelkerung'] * 20)
+        name = self._gen_new_name(title, u'ZH.1', {})
+        hashed = self._gen_new_name(title, u'ZH.2', {name: u'ZH.1'})
+        self.assertNotEqual(hashed, name)
+        self.assertTrue(len(hashed) <= PACKAGE_NAME_MAX_LENGTH)
+        self.assertFalse(u'--' in hashed)
+
+        counted = self._gen_new_name(
+            title, u'ZH.2', {name: u'ZH.1', hashed: u'ZH.3'}
+        )
+        self.assertTrue(counted.endswith(u'-2'))
+        self.assertTrue(len(counted) <= PACKAGE_NAME_MAX_LENGTH)